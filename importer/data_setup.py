@@ -2,15 +2,23 @@ import os
 import re
 from pathlib import Path
 
+from utils import content_utils
+
 
 """
 Source Info
 """
 
+# Formats of downloaded audio, WAV is converted, others are native streams.
+AUDIO_EXTS = ('.wav', '.webm', '.opus', '.m4a', '.mp4', '.mp3', '.ogg', '.aac', '.mka')
+
+
 class SourceInfo:
 
     def __init__(self, src_fp=None):
         self.set_src_fp_same_as_srt(src_fp)
+        self.qa_list = [] # Filled by summarize stage.
+        self.cues = None
     
     def set_src_fp_same_as_srt(self, fp):
         self.src_fp = fp
@@ -31,6 +39,14 @@ class SourceInfo:
     def is_srt_exists(self):
         return self.srt_fp and os.path.exists(self.srt_fp)
 
+    def get_cues(self):
+        """
+        Parse srt once, share by all stages of this source.
+        """
+        if self.cues is None and self.is_srt_exists():
+            self.cues = content_utils.read_cues(self.srt_fp)
+        return self.cues
+
 
 class ZoomSrcInfo(SourceInfo):
 
@@ -45,19 +61,23 @@ class ZoomSrcInfo(SourceInfo):
 
 class YTSrcInfo(SourceInfo):
 
-    def __init__(self, audio_dir, channel_info=None, video_info=None):
+    def __init__(self, audio_dir, channel_info=None, video_info=None, entry=None):
+        """
+        channel_info: Flat listing of channel, entry is the video in it, default is the first.
+        """
         super().__init__(None)
         self.audio_dir = audio_dir
 
         self.video_url = None
         self.author = None
         self.title = None
+        self.caption_langs = None # Default of provider.
     
         if channel_info:
             self.channel_info = channel_info
             self.channel_id = channel_info.get('channel_id')
             self.author     = channel_info['uploader']
-            self.video_info = channel_info['entries'][0]
+            self.video_info = entry or channel_info['entries'][0]
             self.video_url  = self.video_info['url']
             self.watch_url  = self.video_url
             self.video_id   = self.video_info['id']
@@ -76,9 +96,20 @@ class YTSrcInfo(SourceInfo):
         self.title = self.remove_mk_symbol(self.title)
         self.author = self.remove_mk_symbol(self.author)
 
-        self.set_src_fp_same_as_srt(
-            os.path.join(self.audio_dir, "{} - {}{}".format(self.author, self.title, '.wav'))
-        )
+        # Extension of audio is known after download, it depends on format.
+        self.base_fp = os.path.join(self.audio_dir, "{} - {}".format(self.author, self.title))
+        self.src_fp = self.find_audio()
+        self.srt_fp = self.base_fp + ".srt"
+
+    def audio_fps(self):
+        """
+        Downloaded audio of any format.
+        """
+        return [self.base_fp + ext for ext in AUDIO_EXTS if os.path.exists(self.base_fp + ext)]
+
+    def find_audio(self):
+        fps = self.audio_fps()
+        return fps[0] if fps else None
 
     def remove_mk_symbol(self, s):
         if not s:
@@ -104,8 +135,17 @@ class YTSrcInfo(SourceInfo):
 
 class YTChannalSrcInfo(YTSrcInfo):
 
-    def __init__(self, audio_dir, channel_data, channel_info=None, video_info=None):
-        super().__init__(audio_dir, channel_info, video_info)
+    def __init__(self, audio_dir, channel_data, channel_info=None, video_info=None, entry=None):
+        super().__init__(audio_dir, channel_info, video_info, entry)
         self.acc        = channel_data.get("username")
         self.channel_name = channel_data.get("channel_name")
-        self.question   = channel_data.get("question")
\ No newline at end of file
+        self.question   = channel_data.get("question")
+        # Ask more about same video, 'questions' list in channels.yml.
+        self.questions  = channel_data.get("questions") or ([self.question] if self.question else [])
+        # Languages of published captions to use instead of transcribing, in order.
+        self.caption_langs = channel_data.get("captions")
+        # Send only most informative part of transcript to AI, for long live streams.
+        self.extract_tokens = int(channel_data["extract_tokens"]) if channel_data.get("extract_tokens") else None
+        # Set by dedup stage, story this video is the same as, or later videos of same story.
+        self.duplicate_of = None
+        self.duplicates = []
\ No newline at end of file
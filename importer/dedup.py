@@ -0,0 +1,53 @@
+import threading
+
+import numpy as np
+
+from utils import similarity_utils
+
+
+class StoryDeduper:
+    """
+    Find transcript of same story from other channels, in this run or recent days, so it is summarized once.
+    Story: {'title': str, 'url': str, 'link': Logseq link of its transcription}
+    Title is name of transcription '<channel> - <video title>', episodes of same channel are not compared,
+    they share intro, sponsor reads and sign-off.
+    """
+
+    def __init__(self, threshold=0.3):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.stories = []
+        self.counts = []
+
+    def add(self, story, text):
+        with self.lock:
+            self.stories.append(story)
+            self.counts.append(similarity_utils.ngram_counts(text))
+
+    def match(self, story, text):
+        """
+        Return (story, score) of the most similar one over threshold.
+        Otherwise the story is added for later ones and return (None, best score).
+        """
+        counts = similarity_utils.ngram_counts(text)
+        with self.lock:
+            best, best_score = None, 0.0
+            if self.counts:
+                scores = similarity_utils.similarities(np.vstack(self.counts + [counts]), len(self.counts))
+                channel = self.channel_of(story)
+                for i, score in enumerate(scores[:-1]):
+                    if self.channel_of(self.stories[i]) == channel:
+                        continue  # Same channel, or same source imported again.
+                    if score > best_score:
+                        best, best_score = self.stories[i], float(score)
+
+            if best is not None and best_score >= self.threshold:
+                return best, best_score
+
+            self.stories.append(story)
+            self.counts.append(counts)
+            return None, best_score
+
+    @classmethod
+    def channel_of(cls, story):
+        return story['title'].split(" - ", 1)[0]
@@ -1,12 +1,22 @@
+import copy
+import time
+import threading
+import traceback
 from argparse import Namespace
 
 from setup import ServiceSetup
 from importer.data_setup import SourceInfo, YTSrcInfo, YTChannalSrcInfo
 from importer.provider import AudioSourceProvider, ZoomVideoProvider, YTVideoProvider, YTChannelsLatestVideoProvider
 from importer.transcriber import AudioTranscriptor, YTTranscriptor
-from importer.recorder import SimpleRecorder
-from importer.questioner import ClaudeSrtSummary
+from importer.recorder import ItemRecorder
+from importer.questioner import ClaudeSrtSummary, ClaudeBatch
 from importer.output_helper import LogseqHelper
+from importer.pipeline import Stage, StagePipeline
+from importer.search_index import SearchIndex
+from importer.dedup import StoryDeduper
+from importer.report import report
+from utils import file_utils
+from utils import content_utils
 
 
 """
@@ -22,7 +32,9 @@ class AudioImporter:
         self.args = args
         self.proj_setup: ServiceSetup = args.proj_setup
         self.output_helper = LogseqHelper(self.proj_setup)
+        self.recorder = ItemRecorder(self.proj_setup)
         self.proj_setup.change_to_graph(self.args.graph)
+        self._local = threading.local()
 
         self.setup()
         
@@ -32,34 +44,127 @@ class AudioImporter:
         """
         self.provider = AudioSourceProvider(self.args)
         self.transcriptor = AudioTranscriptor(self.args)
-        self.questioner = ClaudeSrtSummary(self.proj_setup)
+        self.questioner = ClaudeSrtSummary(self.proj_setup, self.args)
     
     def start_import(self):
 
         self.questioner.prepare(self.args.ai_model)
+        report.reset()
 
-        for src in self.provider.get_info():
-            
-            if SimpleRecorder.check_if_had_read(self.args.proj_setup, src.get_main_id(), src.get_id()):
-                print("Already read: {} {}".format(src.get_main_id(), src.get_id()))
-                continue
-            
-            if not src.is_srt_exists():
+        # Outputs of the run are written together, items are marked after they are on disk.
+        self.output_helper.begin()
+        self.saved = [] # [(src, content_hash), ...]
+        try:
+            StagePipeline(self.stages(), queue_size=getattr(self.args, 'queue_size', 2)).run(self.provider.get_info())
+            self.finish()
+        finally:
+            self.commit_output()
 
-                if not self.provider.get_src(src):
-                    continue
+        report.print_summary()
 
-                if not self.transcriptor.start_transcribe(src):
-                    print("Skip transcribing: {}".format(src.src_fp))
-                    continue
+    def commit_output(self):
+        self.output_helper.commit()
+        for src, content_hash in self.saved:
+            self.recorder.mark_video_as_read(src.get_main_id(), src.get_id(), content_hash=content_hash)
+            report.count("Imported")
+        self.saved = []
+
+    def finish(self):
+        """
+        Override to handle things after all sources passed the pipeline.
+        """
+        pass
+
+    def stages(self):
+        """
+        Override to add or replace stages, the order is the order of processing.
+        """
+        return [
+            Stage("check", self.check_stage),
+            Stage("download", self.download_stage, workers=getattr(self.args, 'download_workers', 1)),
+            Stage("transcribe", self.transcribe_stage, workers=getattr(self.args, 'transcribe_workers', 1)),
+            Stage("summarize", self.summarize_stage, workers=getattr(self.args, 'summarize_workers', 1)),
+            Stage("save", self.save_stage), # Append to same journal, keep it serial.
+        ]
+
+    def check_stage(self, src:SourceInfo):
+        if self.recorder.check_if_had_read(src.get_main_id(), src.get_id()):
+            print("Already read: {} {}".format(src.get_main_id(), src.get_id()))
+            return None
+        return src
+
+    def download_stage(self, src:SourceInfo):
+        if src.is_srt_exists():
+            return src
+        if self.provider.get_captions(src):
+            return src
+        if not self.provider.get_src(src):
+            return None
+        return src
+
+    def transcribe_stage(self, src:SourceInfo):
+        if src.is_srt_exists():
+            return src
+        if not self.worker_copy('transcriptor').start_transcribe(src):
+            print("Skip transcribing: {}".format(src.src_fp))
+            return None
+        return src
+
+    def summarize_stage(self, src:SourceInfo):
+        return self.summarize(src)
+
+    def summarize(self, src:SourceInfo, ans=None):
+        """
+        ans: Answer of the first prompt if already got, e.g. from batch.
+        """
+        questioner = self.source_questioner(src)
+        prompts = self.get_prompts(src)
+        if ans is None:
+            questioner.summarize_srt(prompts[0], src.srt_fp, cues=src.get_cues())
+        else:
+            questioner.load_context(src.srt_fp, cues=src.get_cues())
+            questioner.stash_qa(prompts[0], ans)
+        for q in prompts[1:]:
+            questioner.ask_follow_up(q)
+        src.qa_list = questioner.qa_list
+        questioner.close_conversation()
+        return src
 
-            self.questioner.summarize_srt(self.get_prompt(src), src.srt_fp)
+    def source_questioner(self, src:SourceInfo):
+        """
+        Questioner of this worker, ready for the source.
+        """
+        questioner = self.worker_copy('questioner')
+        questioner.close_conversation()
+        questioner.extract_tokens = self.get_extract_tokens(src)
+        questioner.cache_context = len(self.get_prompts(src)) > 1
+        return questioner
 
-            self.save(self.args.page, self.questioner.qa_list, src)
-            SimpleRecorder.mark_video_as_read(self.args.proj_setup, src.get_main_id(), src.get_id())
+    def get_extract_tokens(self, src:SourceInfo):
+        return getattr(self.args, 'extract_tokens', 0)
 
-            self.questioner.close_conversation()
+    def save_stage(self, src:SourceInfo):
+        self.save(self.args.page, src.qa_list, src)
+        self.saved.append((src, file_utils.hash_file(src.srt_fp)))
+        src.cues = None
+        return src
+
+    def worker_copy(self, name):
+        """
+        Transcriptor and questioner keep state of current source, every worker thread get its own copy.
+        """
+        obj = getattr(self._local, name, None)
+        if obj is None:
+            obj = copy.copy(getattr(self, name))
+            setattr(self._local, name, obj)
+        return obj
     
+    def get_prompts(self, src)-> list[str]:
+        """
+        Questions from command line, or from source. The first one is sent with transcript.
+        """
+        return getattr(self.args, 'question', None) or [self.get_prompt(src)]
+
     def get_prompt(self, src):
         """
         Override to get prompt by source.
@@ -68,9 +173,9 @@ class AudioImporter:
 
     def save(self, page, qa_list, src:SourceInfo):
         if page:
-            self.output_helper.save_summary_under_page(page, qa_list, src.srt_fp)
+            self.output_helper.save_summary_under_page(page, qa_list, src.srt_fp, cues=src.get_cues())
         else:
-            self.output_helper.save_summary_under_daily(qa_list, src.srt_fp)
+            self.output_helper.save_summary_under_daily(qa_list, src.srt_fp, cues=src.get_cues())
 
 
 """
@@ -85,7 +190,7 @@ class ZoomRecordImporter(AudioImporter):
     def setup(self):
         self.provider = ZoomVideoProvider(self.args)
         self.transcriptor = AudioTranscriptor(self.args)
-        self.questioner = ClaudeSrtSummary(self.proj_setup)
+        self.questioner = ClaudeSrtSummary(self.proj_setup, self.args)
 
 
 """
@@ -97,13 +202,13 @@ class YTImporter(AudioImporter):
     def setup(self):
         self.provider = YTVideoProvider(self.args)
         self.transcriptor = YTTranscriptor(self.args)
-        self.questioner = ClaudeSrtSummary(self.proj_setup)
+        self.questioner = ClaudeSrtSummary(self.proj_setup, self.args)
     
     def save(self, page, qa_list, src:YTSrcInfo):
         if page:
-            self.output_helper.save_summary_under_page_with_url(page, qa_list,src.video_url, src.srt_fp)
+            self.output_helper.save_summary_under_page_with_url(page, qa_list,src.video_url, src.srt_fp, cues=src.get_cues())
         else:
-            self.output_helper.save_summary_under_daily_with_url(qa_list, src.video_url, src.srt_fp)
+            self.output_helper.save_summary_under_daily_with_url(qa_list, src.video_url, src.srt_fp, cues=src.get_cues())
 
 
 """
@@ -113,9 +218,176 @@ news
 class DailyNewsImporter(YTImporter):
 
     def setup(self):
-        self.provider = YTChannelsLatestVideoProvider(self.args)
+        self.provider = YTChannelsLatestVideoProvider(self.args, recorder=self.recorder)
         self.transcriptor = YTTranscriptor(self.args)
-        self.questioner = ClaudeSrtSummary(self.proj_setup)
+        self.questioner = ClaudeSrtSummary(self.proj_setup, self.args)
+
+        self.batch = None
+        self.batch_items = [] # [(src, custom_id), ...]
+        if getattr(self.args, 'llm_batch', False):
+            self.batch = ClaudeBatch(self.questioner, poll_interval=getattr(self.args, 'llm_batch_poll', 30))
+
+        self.deduper = None
+        self.deferred = [] # Saved after all stories are compared.
+        if getattr(self.args, 'dedup_threshold', 0) > 0:
+            self.deduper = StoryDeduper(self.args.dedup_threshold)
+            self.load_dedup_history(getattr(self.args, 'dedup_days', 2))
+
+    def load_dedup_history(self, days):
+        """
+        Stories saved in recent days are compared too, from search index.
+        """
+        count = 0
+        for doc in SearchIndex(self.proj_setup).recent_docs(time.time() - days * 86400):
+            self.deduper.add({'title': doc['title'], 'url': doc['url'], 'link': LogseqHelper.md_link(doc['md_fp'])}, doc['text'])
+            count += 1
+        print("Compare stories with {} transcriptions of {} days.".format(count, days))
+
+    def stages(self):
+        stages = super().stages()
+        if self.deduper:
+            i = next(i for i, stage in enumerate(stages) if stage.name == "transcribe")
+            stages.insert(i + 1, Stage("dedup", self.dedup_stage)) # Compare in order, keep it serial.
+        return stages
+
+    def dedup_stage(self, src:YTChannalSrcInfo):
+        """
+        Same story from other channel is not summarized, it is saved with link to the first one.
+        """
+        story = {
+            'title': src.get_srt_fn(),
+            'url': src.video_url,
+            'link': self.output_helper.transcription_link(src.srt_fp, self.args.page),
+            'src': src,
+        }
+        text = content_utils.srt_file_to_txt_content(src.srt_fp, cues=src.get_cues())
+        match, score = self.deduper.match(story, text)
+        if not match:
+            return src
+
+        print("Same story as {} ({:.2f}), skip summarizing: {}".format(match['title'], score, src.title))
+        src.duplicate_of = match
+        if match.get('src'):
+            match['src'].duplicates.append(story)
+        report.count("Duplicate stories")
+        report.count("LLM calls saved by dedup", len(self.get_prompts(src)))
+        return src
+
+    def save_stage(self, src:YTChannalSrcInfo):
+        """
+        With dedup, a later video of same story may be compared after this one passed save stage,
+        save when pipeline is done, links to all duplicates are known then.
+        """
+        if not self.deduper:
+            return super().save_stage(src)
+        src.cues = None # Parsed again when saving.
+        self.deferred.append(src)
+        return src
+
+    def commit_output(self):
+        """
+        Originals are saved first, a duplicate whose original of this run failed is summarized itself,
+        otherwise it would link to a transcription never written.
+        """
+        deferred, self.deferred = self.deferred, []
+        saved = set()
+        duplicates = []
+        for src in deferred:
+            if src.duplicate_of and src.duplicate_of.get('src'):
+                duplicates.append(src)
+            elif self.save_deferred(src):
+                saved.add(id(src))
+
+        for src in duplicates:
+            if id(src.duplicate_of['src']) not in saved:
+                print("Original of same story was not saved, summarize: {}".format(src.title))
+                report.count("Duplicate stories", -1)
+                report.count("LLM calls saved by dedup", -len(self.get_prompts(src)))
+                src.duplicate_of = None
+                try:
+                    src = self.summarize(src)
+                except Exception:
+                    print("Summarize failed: {}".format(src.srt_fp))
+                    traceback.print_exc()
+                    report.count("Failed: summarize")
+                    continue
+            self.save_deferred(src)
+        super().commit_output()
+
+    def save_deferred(self, src:YTChannalSrcInfo):
+        try:
+            super().save_stage(src)
+            return True
+        except Exception:
+            print("Save failed: {}".format(src.srt_fp))
+            traceback.print_exc()
+            report.count("Failed: save")
+            return False
+
+    def save(self, page, qa_list, src:YTChannalSrcInfo):
+        if src.duplicates:
+            qa_list = qa_list + [("", "\n".join(
+                "- 相同新聞: {} - [Link]({})".format(story['link'], story['url']) for story in src.duplicates
+            ))]
+        super().save(page, qa_list, src)
+
+    def get_prompts(self, src:YTChannalSrcInfo):
+        return getattr(self.args, 'question', None) or src.questions or [self.get_prompt(src)]
 
     def get_prompt(self, src:YTChannalSrcInfo):
         return src.question
+
+    def get_extract_tokens(self, src:YTChannalSrcInfo):
+        # 'extract_tokens' of channel in channels.yml first.
+        if src.extract_tokens is not None:
+            return src.extract_tokens
+        return super().get_extract_tokens(src)
+
+    def summarize_stage(self, src:YTChannalSrcInfo):
+        """
+        In batch mode, queue the first prompt and save after all results come back.
+        """
+        if src.duplicate_of:
+            story = src.duplicate_of
+            src.qa_list = [("", "- 相同新聞，未重複摘要: {} - [Link]({})".format(story['link'], story['url']))]
+            return src
+
+        if not self.batch:
+            return super().summarize_stage(src)
+
+        questioner = self.source_questioner(src)
+        if not questioner.load_context(src.srt_fp, cues=src.get_cues()):
+            return super().summarize_stage(src) # Chunked summary keep synchronous.
+
+        params = questioner.build_params(
+            questioner.wrap_conversation(next_q=self.get_prompts(src)[0]),
+            system_role=questioner.init_prompt,
+        )
+        questioner.close_conversation()
+        if questioner.is_cached(params):
+            return super().summarize_stage(src)
+
+        self.batch_items.append((src, self.batch.add(params)))
+        return None
+
+    def finish(self):
+        if not self.batch_items:
+            return
+
+        try:
+            answers = self.batch.run()
+        except Exception as e:
+            print("Batch failed, fallback to synchronous: {}".format(e))
+            answers = {}
+
+        for src, custom_id in self.batch_items:
+            ans = answers.get(custom_id)
+            if ans is None:
+                report.count("LLM batch fallback")
+            try:
+                self.save_stage(self.summarize(src, ans=ans))
+            except Exception:
+                print("Save failed: {}".format(src.srt_fp))
+                traceback.print_exc()
+                report.count("Failed: save")
+        self.batch_items = []
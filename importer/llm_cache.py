@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+from importer.report import report
+
+
+class LLMCache:
+    """
+    Content addressed responses on disk, evict least recently used when over size.
+    Key is hash of everything decide the answer: model, system prompt, messages, temperature and max_tokens.
+    """
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, ttl=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl  # Seconds, None will keep until evicted.
+        self.lock = threading.Lock()
+        self.total_bytes = None
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @classmethod
+    def key(cls, **params):
+        raw = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def entry_fp(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        fp = self.entry_fp(key)
+        try:
+            with open(fp, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            report.count("LLM cache miss")
+            return None
+
+        if self.ttl and time.time() - entry.get('ts', 0) > self.ttl:
+            self.remove(fp)
+            report.count("LLM cache miss")
+            return None
+
+        try:
+            os.utime(fp)  # Mark recently used.
+        except OSError:
+            pass # Evicted by other worker after read, answer is still good.
+        report.count("LLM cache hit")
+        return entry.get('ans')
+
+    def contains(self, key):
+        # Peek without counting hit or miss.
+        return os.path.exists(self.entry_fp(key))
+
+    def set(self, key, ans):
+        fp = self.entry_fp(key)
+        # Own tmp for each writer, workers may write same key at once.
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'ts': time.time(), 'ans': ans}, f, ensure_ascii=False)
+        except Exception:
+            self.remove(tmp)
+            raise
+
+        with self.lock:
+            # Replaced entry was counted already.
+            old_size = os.path.getsize(fp) if os.path.exists(fp) else 0
+            os.replace(tmp, fp)
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.entries())
+            else:
+                self.total_bytes += os.path.getsize(fp) - old_size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith(".json"):
+                continue
+            fp = os.path.join(self.cache_dir, fn)
+            try:
+                st = os.stat(fp)
+            except OSError:
+                continue
+            yield fp, st.st_size, st.st_mtime
+
+    def evict(self):
+        """
+        Remove oldest used until under 90% of max size, so it won't evict on every set.
+        """
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for fp, size, _ in entries:
+            if total <= target:
+                break
+            self.remove(fp)
+            total -= size
+        self.total_bytes = total
+
+    def remove(self, fp):
+        try:
+            os.remove(fp)
+        except OSError:
+            pass
@@ -1,10 +1,13 @@
 import os
+import threading
 from pathlib import Path
 from datetime import datetime
 
 from utils import file_utils
 from setup import ServiceSetup
 from utils import content_utils
+from importer.report import report
+from importer.search_index import SearchIndex
 
 
 class MarkDownHelper:
@@ -43,6 +46,61 @@ class MarkDownHelper:
         return "\n".join(md_items)
 
 
+class OutputTransaction:
+    """
+    Collect writes of a run, flush them grouped by file, each file is written to tmp then renamed.
+    Synced folder like iCloud see one change for each file, and a crash never leave half entry.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {} # fp -> {'base': content replace the file or None to append, 'parts': [...]}
+        self.unbatched_ops = 0 # Opens and writes if they were written one by one.
+
+    def append(self, fp, text, ops=2):
+        with self.lock:
+            self.files.setdefault(fp, {'base': None, 'parts': []})['parts'].append(text)
+            self.unbatched_ops += ops
+
+    def write(self, fp, text, ops=2):
+        with self.lock:
+            self.files[fp] = {'base': text, 'parts': []}
+            self.unbatched_ops += ops
+
+    def flush(self):
+        with self.lock:
+            files, self.files = self.files, {}
+            unbatched_ops, self.unbatched_ops = self.unbatched_ops, 0
+
+        ops = 0
+        dirs = set()
+        for fp, change in files.items():
+            parent = os.path.dirname(fp)
+            if parent not in dirs:
+                file_utils.make_dirs_for_fp(fp)
+                dirs.add(parent)
+
+            content = change['base']
+            if content is None:
+                content = ""
+                if os.path.exists(fp):
+                    with open(fp, 'r', encoding='utf-8') as f:
+                        content = f.read()
+                    ops += 1
+            content += "".join(change['parts'])
+
+            tmp_fp = fp + ".tmp"
+            with open(tmp_fp, 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(tmp_fp, fp)
+            ops += 2
+
+        report.count("Output file ops unbatched", unbatched_ops)
+        report.count("Output file ops batched", ops)
+        report.count("Output files written", len(files))
+        return len(files)
+
+
 """
 1. Save summary to journal, save file to daily folder.
     a. News
@@ -58,6 +116,67 @@ class LogseqHelper:
     
     def __init__(self, proj_setup:ServiceSetup):
         self.proj_setup = proj_setup
+        self.transaction = None
+        self.search_index = None
+        self.pending_index = [] # Transcriptions to index after they are written.
+
+    def begin(self):
+        """
+        Keep writes in memory until commit, without it every save is written at once.
+        """
+        self.transaction = OutputTransaction()
+
+    def commit(self):
+        if not self.transaction:
+            return 0
+        transaction, self.transaction = self.transaction, None
+        count = transaction.flush()
+        self.update_index()
+        return count
+
+    def index_transcription(self, md_fp, srt_fp, url=None, cues=None):
+        self.pending_index.append((md_fp, srt_fp, url, cues))
+        if not self.transaction:
+            self.update_index()
+
+    def update_index(self):
+        """
+        Add saved transcriptions to search index, failure won't stop saving.
+        """
+        pending, self.pending_index = self.pending_index, []
+        if not pending:
+            return
+        try:
+            if self.search_index is None:
+                self.search_index = SearchIndex(self.proj_setup)
+            for md_fp, srt_fp, url, cues in pending:
+                title = Path(srt_fp).with_suffix("").name
+                self.search_index.add_srt(self.proj_setup.current_graph.get('name'), md_fp, title, url, srt_fp, cues=cues)
+            report.count("Indexed", len(pending))
+        except Exception as e:
+            print("Update search index failed: {}".format(e))
+            report.count("Failed: index")
+
+    def append_text(self, fp, text):
+        if self.transaction:
+            self.transaction.append(fp, text)
+        else:
+            transaction = OutputTransaction()
+            transaction.append(fp, text)
+            transaction.flush()
+
+    def write_text(self, fp, text, ops=2):
+        if self.transaction:
+            self.transaction.write(fp, text, ops=ops)
+        else:
+            transaction = OutputTransaction()
+            transaction.write(fp, text, ops=ops)
+            transaction.flush()
+
+    def write_md_list(self, srt_fp, md_fp, cues=None):
+        content = content_utils.srt_to_md_list_content(srt_fp, cues=cues)
+        # Unbatched, the list is written line by line.
+        self.write_text(md_fp, content, ops=1 + content.count("\n"))
     
     def page_fp(self, page):
         return os.path.join(
@@ -89,7 +208,24 @@ class LogseqHelper:
             datetime.today().strftime("%Y_%m_%d") + ".md",
         )
     
-    def save_summary_under_page(self, page, qa_list, srt_fp):
+    def transcription_link(self, srt_fp, page=None):
+        """
+        Link of transcription which will be saved for srt.
+        """
+        if page:
+            return self.md_link(self.icloud_fp_len_constrain(self.transcription_page_fp(page, srt_fp)))
+        return self.md_link(self.icloud_fp_len_constrain(self.diary_transcription_fp(srt_fp)))
+
+    @classmethod
+    def md_link(cls, md_fp):
+        p = Path(md_fp)
+        name = p.with_suffix("").name
+        page = p.parent.name
+        if name.startswith(page + "___"):
+            return MarkDownHelper.compose_page_link(page, name)
+        return MarkDownHelper.compose_file_link(name)
+
+    def save_summary_under_page(self, page, qa_list, srt_fp, cues=None):
         md_fp = self.transcription_page_fp(page, srt_fp)
         md_fp = self.icloud_fp_len_constrain(md_fp)
         md_p = Path(md_fp)
@@ -100,9 +236,9 @@ class LogseqHelper:
             MarkDownHelper.compose_summarize_from_qa_lsit_md(qa_list)
         )
 
-        self.save_under_page(sum, page, srt_fp, md_fp=md_fp)
+        self.save_under_page(sum, page, srt_fp, md_fp=md_fp, cues=cues)
 
-    def save_summary_under_daily(self, qa_list, srt_fp):
+    def save_summary_under_daily(self, qa_list, srt_fp, cues=None):
         md_fp = self.diary_transcription_fp(srt_fp)
         md_fp = self.icloud_fp_len_constrain(md_fp)
         md_p = Path(md_fp)
@@ -113,9 +249,9 @@ class LogseqHelper:
             MarkDownHelper.compose_summarize_from_qa_lsit_md(qa_list)
         )
 
-        self.save_under_diary(sum, srt_fp, md_fp=md_fp)
+        self.save_under_diary(sum, srt_fp, md_fp=md_fp, cues=cues)
 
-    def save_summary_under_page_with_url(self, page, qa_list, url, srt_fp):
+    def save_summary_under_page_with_url(self, page, qa_list, url, srt_fp, cues=None):
         md_fp = self.transcription_page_fp(page, srt_fp)
         md_fp = self.icloud_fp_len_constrain(md_fp)
         md_p = Path(md_fp)
@@ -126,9 +262,9 @@ class LogseqHelper:
             MarkDownHelper.compose_summarize_from_qa_lsit_md(qa_list)
         )
 
-        self.save_under_page(sum, page, srt_fp, md_fp=md_fp)
+        self.save_under_page(sum, page, srt_fp, md_fp=md_fp, cues=cues, url=url)
 
-    def save_summary_under_daily_with_url(self, qa_list, url, srt_fp):
+    def save_summary_under_daily_with_url(self, qa_list, url, srt_fp, cues=None):
         md_fp = self.diary_transcription_fp(srt_fp)
         md_fp = self.icloud_fp_len_constrain(md_fp)
         md_p = Path(md_fp)
@@ -139,43 +275,37 @@ class LogseqHelper:
             MarkDownHelper.compose_summarize_from_qa_lsit_md(qa_list)
         )
         
-        self.save_under_diary(sum, srt_fp, md_fp=md_fp)
+        self.save_under_diary(sum, srt_fp, md_fp=md_fp, cues=cues, url=url)
 
-    def save_under_page(self, sum, page, srt_fp, md_fp=None):
+    def save_under_page(self, sum, page, srt_fp, md_fp=None, cues=None, url=None):
         """
         Compose title by use case, not here.
         File: transcriptions/PageName/PageName___FileName.md
         """
         page_fp = self.page_fp(page)
-        file_utils.make_dirs_for_fp(page_fp)
 
-        with open(page_fp, 'a') as src:
-            src.write("\n")
-            src.write(sum)
+        self.append_text(page_fp, "\n" + sum)
         print("Save summary to: " + page_fp)
 
         md_fp = self.transcription_page_fp(page, srt_fp) if not md_fp else md_fp
-        file_utils.make_dirs_for_fp(md_fp)
 
-        content_utils.srt_to_md_list(srt_fp, md_fp)
+        self.write_md_list(srt_fp, md_fp, cues=cues)
+        self.index_transcription(md_fp, srt_fp, url=url, cues=cues)
         print("Saved: " + md_fp)
 
-    def save_under_diary(self, sum, srt_fp, md_fp=None):
+    def save_under_diary(self, sum, srt_fp, md_fp=None, cues=None, url=None):
         """
         File: transcriptions/2021_01_01/FileName.md
         """
         journal_fp = self.daily_journal_fp()
-        file_utils.make_dirs_for_fp(journal_fp)
 
-        with open(journal_fp, 'a') as src:
-            src.write('\n')
-            src.write(sum)
+        self.append_text(journal_fp, '\n' + sum)
         print("Save summary to: " + journal_fp)
 
         md_fp = self.diary_transcription_fp(srt_fp)  if not md_fp else md_fp
-        file_utils.make_dirs_for_fp(md_fp)
 
-        content_utils.srt_to_md_list(srt_fp, md_fp)
+        self.write_md_list(srt_fp, md_fp, cues=cues)
+        self.index_transcription(md_fp, srt_fp, url=url, cues=cues)
         print("Saved to: " + md_fp)
 
     @classmethod
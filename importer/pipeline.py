@@ -0,0 +1,105 @@
+import time
+import queue
+import threading
+import traceback
+from collections.abc import Iterable
+
+from importer.report import report
+
+
+class Stage:
+    """
+    handler(item) return the item for next stage, return None to drop it.
+    """
+
+    def __init__(self, name, handler, workers=1):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, int(workers))
+
+
+class StagePipeline:
+    """
+    Run stages in threads, connect them with bounded queues.
+    While item N is in stage 2, item N+1 can be in stage 1 and item N-1 in stage 3,
+    so the run takes about the time of the slowest stage instead of the sum of all.
+    """
+
+    _END = object()
+
+    def __init__(self, stages: list[Stage], queue_size=2):
+        self.stages = stages
+        self.queue_size = max(1, int(queue_size))
+
+    def run(self, items: Iterable):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = []
+
+        feeder = threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)
+        threads.append(feeder)
+
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for n in range(stage.workers):
+                t = threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[i], queues[i + 1], remaining, lock),
+                    name="{}-{}".format(stage.name, n),
+                    daemon=True,
+                )
+                threads.append(t)
+
+        start = time.monotonic()
+        for t in threads:
+            t.start()
+
+        results = []
+        while True:
+            item = queues[-1].get()
+            if item is self._END:
+                break
+            results.append(item)
+
+        for t in threads:
+            t.join()
+
+        report.add_time("Pipeline wall time", time.monotonic() - start)
+        return results
+
+    def _feed(self, items, out_q):
+        try:
+            for item in items:
+                out_q.put(item)
+        except Exception:
+            print("Provider failed:")
+            traceback.print_exc()
+            report.count("Failed: provider")
+        finally:
+            out_q.put(self._END)
+
+    def _work(self, stage: Stage, in_q, out_q, remaining, lock):
+        while True:
+            item = in_q.get()
+            if item is self._END:
+                # Let siblings see the end too, the last one closes next stage.
+                in_q.put(self._END)
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        out_q.put(self._END)
+                return
+
+            start = time.monotonic()
+            try:
+                result = stage.handler(item)
+            except Exception:
+                print("Stage {} failed:".format(stage.name))
+                traceback.print_exc()
+                report.count("Failed: " + stage.name)
+                result = None
+            finally:
+                report.add_time("Stage " + stage.name, time.monotonic() - start)
+
+            if result is not None:
+                out_q.put(result)
@@ -1,12 +1,20 @@
 import os
-from pathlib import Path
+import glob
+import time
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from collections.abc import Generator
+from urllib.parse import urlparse, parse_qs
 
 from importer.data_setup import SourceInfo, ZoomSrcInfo, YTSrcInfo, YTChannalSrcInfo
 from utils import file_utils
+from utils import content_utils
+from importer.report import report
 
 from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError, parse_bytes
 import yaml
 
 
@@ -24,6 +32,10 @@ class SourceProvider:
         # Get source from download or somewhere else.
         return os.path.exists(src.src_fp)
 
+    def get_captions(self, src: SourceInfo) -> bool:
+        # Write srt from captions of source if it has, then download and transcription are skipped.
+        return False
+
 
 class AudioSourceProvider(SourceProvider):
 
@@ -53,20 +65,23 @@ class ZoomVideoProvider(AudioSourceProvider):
 
 class YTVideoProvider(SourceProvider):
 
+    # Replace with a fake for testing.
+    ydl_cls = YoutubeDL
+
+    # Seconds before expire time of format urls, which they are treated as expired.
+    EXPIRE_MARGIN = 300
+
     def __init__(self, args):
         super().__init__(args)
-        self.yt_link = args.yt_link
+        self.yt_link = getattr(args, 'yt_link', None)
+        self._local = threading.local()
+        self.download_manager = DownloadManager(args)
 
     def get_info(self)-> Generator[YTSrcInfo]:
 
-        ydl_opts = {
-            'playlist_items': '1',
-            'extractor_args': {'youtubetab': {'approximate_date': ['']}}
-        }
-
         try:
-            with YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(self.args.yt_link, download=False)
+            info = self.video_ydl().extract_info(self.args.yt_link, download=False)
+            report.count("YT extract: video")
 
             yield YTSrcInfo(self.args.proj_setup.audio_dir, video_info=info)
         
@@ -79,37 +94,166 @@ class YTVideoProvider(SourceProvider):
             return
         
     def get_src(self, src: YTSrcInfo):
-        src.src_fp = self.download_lowest_quality_audio(src)
+        src.src_fp = self.download_lowest_quality_audio(src, self.audio_format())
         if not src.src_fp or not os.path.exists(src.src_fp):
             print("===== Donwload failed. =====")
             return False
         return True
 
-    def download_lowest_quality_audio(self, src: YTSrcInfo, audio_format='.wav'):
+    def get_captions(self, src: YTSrcInfo) -> bool:
+        """
+        Use captions published with the video if one in preferred languages exists.
+        """
+        langs = self.preferred_captions(src)
+        if not langs:
+            return False
 
-        fp = src.src_fp
+        info = src.video_info or {}
+        if 'subtitles' not in info and 'automatic_captions' not in info:
+            # Entry of channel listing has no captions, the full info is kept for download.
+            try:
+                info = self.resolve(src)
+            except Exception as e:
+                print("Check captions failed: {} {}".format(src.video_url, e))
+                return False
 
-        if os.path.exists(fp):
-            print("Audio exists: " + fp)
-            return fp
-        
-        # The ydl will transform audio format as you assign, if your fp has ext in path, ydl will append ext directly.
-        # Like input: aaa.wav
-        # In result: aaa.wav.wav
-        no_ext_fp = Path(fp).with_suffix("").as_posix()
+        lang, track = self.pick_caption(info, langs)
+        if not track:
+            return False
 
-        ydl_opts = {
-            'outtmpl': no_ext_fp,
+        try:
+            content = self.video_ydl().urlopen(track['url']).read().decode('utf-8')
+        except Exception as e:
+            print("Download captions failed: {} {}".format(src.video_url, e))
+            return False
+
+        cues = list(content_utils.parse_vtt_lines(content.splitlines(True)))
+        duration = info.get('duration')
+        if not cues or (duration and cues[-1].end / 1000 < duration / 2):
+            print("Captions {} is incomplete, transcribe instead: {}".format(lang, src.video_url))
+            return False
+
+        segments = [{
+            'start': cue.start / 1000,
+            'end': cue.end / 1000,
+            'text': content_utils.s_to_t_text(cue.text, cache_dir=self.args.proj_setup.cache_dir),
+        } for cue in cues]
+        tmp_fp = src.srt_fp + ".tmp"
+        content_utils.write_srt(segments, tmp_fp)
+        os.replace(tmp_fp, src.srt_fp)
+
+        print("Use captions {}, skip transcribing: {}".format(lang, src.title))
+        report.count("Captions used")
+        report.count("Captions used: " + lang)
+        return True
+
+    def preferred_captions(self, src: YTSrcInfo):
+        # 'captions' of channel in channels.yml first, empty list to always transcribe.
+        if getattr(src, 'caption_langs', None) is not None:
+            return src.caption_langs
+        return [lang.strip() for lang in (getattr(self.args, 'caption_langs', None) or "").split(",") if lang.strip()]
+
+    def pick_caption(self, info, langs):
+        """
+        First track in order of langs, 'auto:<lang>' for captions generated by YouTube.
+        Return (lang, track) or (None, None).
+        """
+        for lang in langs:
+            if lang.startswith("auto:"):
+                tracks = info.get('automatic_captions') or {}
+                formats = tracks.get(lang[len("auto:"):]) or []
+            else:
+                tracks = info.get('subtitles') or {}
+                formats = tracks.get(lang) or []
+            for f in formats:
+                if f.get('ext') == 'vtt' and f.get('url'):
+                    return lang, f
+        return None, None
+
+    def get_ydl(self, name, opts):
+        # YoutubeDL is not thread safe, reuse one of each kind for each worker in this run.
+        ydls = self._local.__dict__.setdefault('ydls', {})
+        if name not in ydls:
+            ydls[name] = self.ydl_cls(opts)
+        return ydls[name]
+
+    def video_ydl(self, audio_format=None):
+        """
+        For extracting and downloading video, output path is set before each download.
+        audio_format: None keep native stream as downloaded, transcriber decode it directly.
+        """
+        opts = {
+            'quiet': True,
             'format': 'worstaudio/worst',
-            'postprocessors': [{
+            **self.download_manager.ydl_opts(),
+        }
+        if audio_format:
+            opts['postprocessors'] = [{
                 'key': 'FFmpegExtractAudio',
                 'preferredcodec': audio_format.replace(".", ""), # Remove '.' for user to keep consistency of meaning.
-            }],
-        }
+            }]
+        return self.get_ydl('video {}'.format(audio_format), opts)
+
+    def audio_format(self):
+        fmt = getattr(self.args, 'yt_audio_format', 'native')
+        return None if fmt == 'native' else '.' + fmt
+
+    def resolve(self, src: YTSrcInfo, force=False):
+        """
+        Full info of video, extracted once and kept on src.
+        Extract again only if format urls expired, e.g. video waited long in queue.
+        """
+        info = src.video_info or {}
+        if info.get('formats') and not force and not self.is_expired(info):
+            return info
+
+        kind = "re-resolve" if info.get('formats') else "video"
+        info = self.video_ydl().extract_info(src.video_url, download=False)
+        report.count("YT extract: " + kind)
+        src.video_info = info
+        return info
+
+    def is_expired(self, info):
+        # Format urls of YouTube are signed with expire time.
+        deadline = time.time() + self.EXPIRE_MARGIN
+        for f in info.get('formats') or []:
+            expire = parse_qs(urlparse(f.get('url') or "").query).get('expire')
+            if expire and expire[0].isdigit() and int(expire[0]) < deadline:
+                return True
+        return False
+
+    def download_lowest_quality_audio(self, src: YTSrcInfo, audio_format=None):
+        """
+        audio_format: e.g. '.wav' convert by ffmpeg after download, None keep native format, e.g. webm or m4a.
+        Return path of audio.
+        """
+        fp = src.find_audio()
+        if fp:
+            print("Audio exists: " + fp)
+            return fp
+
+        if audio_format:
+            # The ydl will transform audio format as you assign, if your fp has ext in path, ydl will append ext directly.
+            # Like input: aaa.wav
+            # In result: aaa.wav.wav
+            outtmpl = src.base_fp
+        else:
+            outtmpl = src.base_fp + ".%(ext)s"
+
+        if glob.glob(glob.escape(src.base_fp) + "*.part"):
+            print("Resume download: " + src.base_fp)
+            report.count("YT download resumed")
 
         try:
-            with YoutubeDL(ydl_opts) as ydl:
-                ydl.download([src.video_url])
+            ydl = self.video_ydl(audio_format)
+            ydl.params['outtmpl']['default'] = outtmpl
+            try:
+                # Download by kept info, no extraction again.
+                info = ydl.process_ie_result(self.resolve(src), download=True)
+            except DownloadError:
+                # Format urls may be rejected before expire time, try once with fresh info.
+                info = ydl.process_ie_result(self.resolve(src, force=True), download=True)
+            report.count("YT download")
 
         except Exception as e:
             err_msg = str(e).lower()
@@ -121,59 +265,197 @@ class YTVideoProvider(SourceProvider):
                 return None
             else:
                 raise e
-            
+
+        downloads = (info or {}).get('requested_downloads') or []
+        fp = downloads[0].get('filepath') if downloads else None
+        if not fp or not os.path.exists(fp):
+            fp = src.find_audio()
+        if fp:
+            report.count("YT audio MB", round(os.path.getsize(fp) / 1024 / 1024, 1))
         return fp
 
 
-class YTChannelsLatestVideoProvider(YTVideoProvider):
+class DownloadManager:
+    """
+    Options shared by all YT downloads of a run, downloads run in parallel by workers of download stage.
+    Bandwidth limit is for all downloads together, a thread which got more bytes than its share sleeps
+    in progress hook, that works for fragments in threads too.
+    """
+
+    BURST_SEC = 1.0
 
     def __init__(self, args):
-        self.args = args
+        self.fragments = max(1, getattr(args, 'download_fragments', 1))
+        self.rate = parse_bytes(getattr(args, 'download_rate_limit', None) or "") # Bytes per second.
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+        self.downloaded = {} # Bytes of each file have been counted, from the first hook of it.
+
+    def ydl_opts(self):
+        opts = {
+            'concurrent_fragment_downloads': self.fragments,
+            'continuedl': True,  # Resume .part left by crashed run.
+            'retries': 10,
+            'fragment_retries': 10,
+        }
+        if self.rate:
+            opts['progress_hooks'] = [self.throttle]
+        return opts
+
+    def throttle(self, d):
+        key = d.get('tmpfilename') or d.get('filename')
+        if d.get('status') != 'downloading':
+            with self.lock:
+                self.downloaded.pop(key, None)
+            return
+
+        n = d.get('downloaded_bytes') or 0
+        with self.lock:
+            # Bytes of resumed .part are in the first hook, they were not downloaded now.
+            delta = n - self.downloaded.get(key, n)
+            self.downloaded[key] = n
+            if delta <= 0:
+                return
+            # Reserve time for these bytes after all bytes got before.
+            now = time.monotonic()
+            self.next_at = max(now - self.BURST_SEC, self.next_at) + delta / self.rate
+            wait = self.next_at - now
+
+        if wait > 0:
+            time.sleep(wait)
+            report.add_time("Download throttled", wait)
+
+
+class YTChannelsLatestVideoProvider(YTVideoProvider):
+
+    # Entries are looked up in recorder by batch.
+    CHECK_BATCH = 10
+
+    def __init__(self, args, recorder=None):
+        super().__init__(args)
+        self.recorder = recorder
         self.monitor_list_path = os.path.abspath(os.path.expanduser(args.monitor_list_path))
+        self.scan_workers = getattr(args, 'scan_workers', 8)
+        self.scan_timeout = getattr(args, 'scan_timeout', 60)
+        self.catch_up_days = getattr(args, 'catch_up_days', 3)
+        self.catch_up_limit = getattr(args, 'catch_up_limit', 30)
 
     def get_info(self)-> Generator[YTChannalSrcInfo]:
-
+        """
+        Scan channels concurrently, yield as soon as one is done, so download don't wait for the slowest channel.
+        """
         with open(self.monitor_list_path, 'r') as f:
             monitor_list = yaml.load(f, Loader=yaml.BaseLoader)
 
-        for data in monitor_list:
+        started = {}
 
-            print("Checking: " + data.get('channel_name'))
+        def scan(i, data):
+            started[i] = time.monotonic()
+            return self.scan_channel(data)
 
-            is_live = data.get("is_live", False)
+        executor = ThreadPoolExecutor(max_workers=max(1, self.scan_workers))
+        pending = {}
+        try:
+            for i, data in enumerate(monitor_list):
+                pending[executor.submit(scan, i, data)] = (i, data)
+
+            while pending:
+                done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    _, data = pending.pop(future)
+                    try:
+                        srcs = future.result()
+                    except Exception as e:
+                        print("Check channel failed: {} {}".format(data.get('channel_name'), e))
+                        continue
+                    yield from srcs
+
+                now = time.monotonic()
+                for future, (i, data) in list(pending.items()):
+                    # Finished while consumer was slow, collected by next wait.
+                    if future.done():
+                        continue
+                    # Thread can't be killed, just stop waiting for it.
+                    if i in started and now - started[i] > self.scan_timeout:
+                        print("Check channel timeout, skip: " + data.get('channel_name'))
+                        pending.pop(future)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def channel_ydl(self):
+        # Flat listing of channel tab, entries have no formats, video is resolved when it is checked or downloaded.
+        return self.get_ydl('channel', {
+            'extract_flat': 'in_playlist',
+            'socket_timeout': self.scan_timeout,
+            'extractor_args': {'youtubetab': {'approximate_date': ['']}}
+        })
 
-            url = 'https://www.youtube.com/@{}/{}'.format(data.get("username"), "streams" if is_live else "videos")
+    def scan_channel(self, data)-> list[YTChannalSrcInfo]:
+        """
+        Page through flat listing of channel tab from the newest, stop at the last recorded video,
+        so videos posted between runs are not missed. Usually the first page is enough.
+        Return unseen videos from the oldest.
+        """
+        print("Checking: " + data.get('channel_name'))
 
-            ydl_opts = {
-                'playlist_items': '1',
-                'extract_flat': 'in_playlist',
-                'extractor_args': {'youtubetab': {'approximate_date': ['']}}
-            }
+        is_live = data.get("is_live", False)
 
-            try:
-                with YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=False)
+        url = 'https://www.youtube.com/@{}/{}'.format(data.get("username"), "streams" if is_live else "videos")
 
-            except Exception as e:
-                err_msg = str(e).lower()
-                if "members-only content" in err_msg:
-                    print("The video is member-only, skip: {}".format(url))
+        try:
+            # Not processed, entries is a generator which requests next page only when it is reached.
+            info = self.channel_ydl().extract_info(url, download=False, process=False)
+            report.count("YT extract: channel")
+
+        except Exception as e:
+            err_msg = str(e).lower()
+            if "members-only content" in err_msg:
+                print("The video is member-only, skip: {}".format(url))
+                return []
+            raise e
+
+        if not info:
+            print("No video in channel: " + url)
+            return []
+
+        channel_info = {k: v for k, v in info.items() if k != 'entries'}
+        oldest = datetime.today() - timedelta(days=self.catch_up_days)
+        entries = iter(info.get('entries') or [])
+        srcs = []
+        checked = 0
+        done = False
+        while not done and checked < self.catch_up_limit:
+            batch = list(itertools.islice(entries, min(self.CHECK_BATCH, self.catch_up_limit - checked)))
+            if not batch:
+                break
+            checked += len(batch)
+
+            batch_srcs = [
+                YTChannalSrcInfo(self.args.proj_setup.audio_dir, data, channel_info=channel_info, entry=entry)
+                for entry in batch
+            ]
+            had_read = self.recorder.filter_had_read(batch_srcs[0].get_main_id(), [src.get_id() for src in batch_srcs]) \
+                if self.recorder else set()
+
+            for src in batch_srcs:
+                if src.get_id() in had_read:
+                    done = True # Older videos were seen by earlier runs.
+                    break
+
+                ts = src.video_info.get('timestamp')
+                if not ts:
+                    print("Video is not ready, skip: {} {}".format(src.title, src.video_url))
                     continue
-                
-            first_v_info = info['entries'][0]
-            ts = first_v_info.get('timestamp')
-            if not ts:
-                print("Video is not ready, skip: {} {}".format(first_v_info.get("title"), first_v_info.get("url")))
-                continue
-
-            pt = datetime.fromtimestamp(ts)
-            
-            if (datetime.today() - pt) / timedelta(hours=1) > 24:
-                print("Video publish at {} is not fresh.".format(pt))
-                continue
-
-            yield YTChannalSrcInfo(
-                self.args.proj_setup.audio_dir,
-                data, 
-                channel_info=info,
-            )
\ No newline at end of file
+
+                pt = datetime.fromtimestamp(ts)
+                if pt < oldest:
+                    print("Video publish at {} is not fresh.".format(pt))
+                    done = True
+                    break
+
+                srcs.append(src)
+
+        report.count("YT channel entries checked", checked)
+        report.count("YT new videos", len(srcs))
+        return srcs[::-1]
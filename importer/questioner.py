@@ -1,16 +1,28 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 from utils import content_utils
 
 from setup import ServiceSetup
+from importer.llm_cache import LLMCache
+from importer.report import report
 
 import anthropic
 
 
 class Querioner:
 
-    def __init__(self, proj_setup: ServiceSetup):
+    def __init__(self, proj_setup: ServiceSetup, args=None):
         self.proj_setup = proj_setup
+        self.args = args
         self.chat = None
+        self.cache = None
         self.qa_list = [] # [ (prompt, ans), ....]
+        self.context = None # Transcript, sent with the first prompt.
+        self.cache_context = False # More than one question about the context, worth caching by AI service.
 
     def prepare(self):
         """Override to implement for ai model service."""
@@ -34,8 +46,14 @@ class Querioner:
             conversation.append({"role": "assistant", "content": a})
         if next_q:
             conversation.append({"role": "user", "content": next_q})
+        if self.context and conversation:
+            conversation[0]["content"] = self.wrap_context(conversation[0]["content"])
         return conversation
 
+    def wrap_context(self, q):
+        """Override to format the first prompt with context."""
+        return "\n".join([q, self.context])
+
 
 class ClaudeQuestioner(Querioner):
 
@@ -46,48 +64,257 @@ class ClaudeQuestioner(Querioner):
 
         self.chat = anthropic.Anthropic(
             api_key=self.proj_setup.anthropic_key,
+            base_url=self.proj_setup.anthropic_base_url, # None for official service.
         )
         self.qa_list = []
 
+        self.cache = None
+        if not getattr(self.args, 'no_llm_cache', False):
+            ttl_days = getattr(self.args, 'llm_cache_ttl', 0)
+            self.cache = LLMCache(
+                os.path.join(self.proj_setup.cache_dir, "llm"),
+                max_bytes=getattr(self.args, 'llm_cache_size', 200) * 1024 * 1024,
+                ttl=ttl_days * 24 * 3600 if ttl_days else None,
+            )
+
     def close_conversation(self):
         self.qa_list = []
+        self.context = None
+
+    def wrap_context(self, q):
+        """
+        Transcript first, mark it cacheable only if follow-up questions will read it,
+        writing cache costs more than normal input.
+        """
+        context = {"type": "text", "text": self.context}
+        if self.cache_context:
+            context["cache_control"] = {"type": "ephemeral"}
+        return [context, {"type": "text", "text": q}]
 
     def ask(self, prompt, system_role=None):
-        responses = self.chat.messages.create(
+        ans = self.create_message(self.wrap_conversation(next_q=prompt), system_role=system_role)
+        self.stash_qa(prompt, ans)
+        return ans
+
+    def build_params(self, messages, system_role=None, max_tokens=3000):
+        return dict(
             model=self.model,
-            max_tokens=3000,
+            max_tokens=max_tokens,
             temperature=0.0,
-            system=system_role,
-            messages=self.wrap_conversation(next_q=prompt)
+            system=[{"type": "text", "text": system_role, "cache_control": {"type": "ephemeral"}}] if system_role else [],
+            messages=messages,
         )
 
+    def create_message(self, messages, system_role=None, max_tokens=3000):
+        """
+        One request without touching qa_list, safe to call from many threads.
+        """
+        return self.send(self.build_params(messages, system_role=system_role, max_tokens=max_tokens))
+
+    def send(self, params):
+        """
+        Same request will be answered from cache, re-run after crash won't pay again.
+        """
+        key = None
+        if self.cache:
+            key = self.cache.key(**params)
+            ans = self.cache.get(key)
+            if ans is not None:
+                return ans
+
+        responses = self.chat.messages.create(**params)
+        self.record_usage(responses)
+
         ans = "".join([ chunk.text for chunk in responses.content ])
-        self.stash_qa(prompt, ans)
+        if self.cache:
+            self.cache.set(key, ans)
         return ans
 
+    def is_cached(self, params):
+        return bool(self.cache) and self.cache.contains(self.cache.key(**params))
+
+    def record_usage(self, message):
+        usage = getattr(message, 'usage', None)
+        if usage:
+            report.count("LLM input tokens", getattr(usage, 'input_tokens', 0) or 0)
+            report.count("LLM prompt cache read tokens", getattr(usage, 'cache_read_input_tokens', 0) or 0)
+            report.count("LLM prompt cache write tokens", getattr(usage, 'cache_creation_input_tokens', 0) or 0)
+
+
+class ClaudeBatch:
+    """
+    Queue requests of a run, submit them together by Message Batches and poll for results.
+    Batch is half price, and pipeline don't wait for AI model service.
+    """
+
+    def __init__(self, questioner: ClaudeQuestioner, poll_interval=30, timeout=24 * 3600):
+        self.questioner = questioner
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.requests = {} # custom_id: params
+        self.lock = threading.Lock()
+
+    def add(self, params)-> str:
+        with self.lock:
+            custom_id = "req-{}".format(len(self.requests))
+            self.requests[custom_id] = params
+        return custom_id
+
+    def run(self)-> dict:
+        """
+        Return {custom_id: ans}, failed requests are not included.
+        """
+        if not self.requests:
+            return {}
+
+        batches = self.questioner.chat.messages.batches
+        batch = batches.create(requests=[
+            {"custom_id": custom_id, "params": params} for custom_id, params in self.requests.items()
+        ])
+        print("Batch submitted: {} with {} requests".format(batch.id, len(self.requests)))
+        report.count("LLM batch requests", len(self.requests))
+
+        start = time.monotonic()
+        while batch.processing_status != "ended":
+            if time.monotonic() - start > self.timeout:
+                print("Batch timeout, cancel: " + batch.id)
+                batches.cancel(batch.id)
+                return {}
+            time.sleep(self.poll_interval)
+            batch = batches.retrieve(batch.id)
+
+        answers = {}
+        for result in batches.results(batch.id):
+            if result.result.type != "succeeded":
+                print("Batch request {}: {}".format(result.custom_id, result.result.type))
+                continue
+
+            message = result.result.message
+            self.questioner.record_usage(message)
+            ans = "".join([ chunk.text for chunk in message.content ])
+            answers[result.custom_id] = ans
+
+            cache = self.questioner.cache
+            if cache:
+                cache.set(cache.key(**self.requests[result.custom_id]), ans)
+
+        report.count("LLM batch failed", len(self.requests) - len(answers))
+        return answers
+
 
 class ClaudeSrtSummary(ClaudeQuestioner):
 
-    def __init__(self, proj_setup):
-        super().__init__(proj_setup)
+    PROMPT_CACHE_SIZE = 64
+
+    def __init__(self, proj_setup, args=None):
+        super().__init__(proj_setup, args)
         self.init_prompt = "你是世界前500強執行長的的秘書，我將給予讀稿，請從讀稿中，使用繁體中文回覆請求，並且只使用Markdown unordered list '- '格式來進行排版，即便是標題也需要使用 '- '"
+        self.chunk_prompt = "以下是讀稿的第 {}/{} 段，請針對這一段回覆請求，保留重要細節，之後會與其他段落合併。"
+        self.reduce_prompt = "以下是同一份讀稿分段整理的結果，請合併成一份完整的回覆，去除重複內容，並依照順序排列。"
+
+        # Transcript longer than this will be split at cue boundaries and summarized concurrently.
+        self.chunk_tokens = getattr(args, 'summary_chunk_tokens', 20000)
+        self.chunk_workers = getattr(args, 'summary_chunk_workers', 4)
 
-    def summarize_srt(self, q, srt_fp, with_ts=False):
+        # Noise of transcription is removed from prompt, srt is not changed.
+        self.cleanup = not getattr(args, 'no_cleanup', False)
+        self.fillers = content_utils.FILLERS + (getattr(args, 'filler', None) or []) + proj_setup.fillers
+        # srt_fp -> cues sent to model, shared by worker copies, so batch and fallback don't clean again.
+        self.prompt_cache = OrderedDict()
+        self.prompt_cache_lock = threading.Lock()
+
+        # Send only most informative cues up to these tokens, 0 to send all, set for each source by importer.
+        self.extract_tokens = getattr(args, 'extract_tokens', 0)
+
+    def summarize_srt(self, q, srt_fp, with_ts=False, cues=None):
         if not srt_fp:
             return
-        
+
+        if not self.load_context(srt_fp, with_ts=with_ts, cues=cues):
+            return self.summarize_chunks(q, self.prompt_cues(srt_fp, cues))
+
+        print("Ask: " + q)
+        ans = self.ask(q, system_role=self.init_prompt)
+        print("Ans:" + ans)
+
+    def load_context(self, srt_fp, with_ts=False, cues=None):
+        """
+        Set transcript as context, return False if it is too long for one request.
+        """
         content = None
         if with_ts:
             with open(srt_fp) as src:
                 content = src.read()
         else:
-            content = content_utils.srt_file_to_txt_content(srt_fp)
-        
+            content = content_utils.srt_file_to_txt_content(srt_fp, cues=self.prompt_cues(srt_fp, cues))
+
+            if self.chunk_tokens and content_utils.estimate_tokens(content) > self.chunk_tokens:
+                return False
+
         # Sent init prompt and content at once, will get better result for lower model.
-        
+        self.context = content
+        return True
+
+    def prompt_cues(self, srt_fp, cues=None):
+        """
+        Cues sent to model, cleaned once for each source.
+        """
+        with self.prompt_cache_lock:
+            if srt_fp in self.prompt_cache:
+                return self.prompt_cache[srt_fp]
+
+        cues = cues if cues is not None else content_utils.read_cues(srt_fp)
+        if self.cleanup:
+            before = content_utils.estimate_tokens(content_utils.srt_file_to_txt_content(None, cues=cues))
+            cues = content_utils.clean_cues(cues, fillers=self.fillers)
+            after = content_utils.estimate_tokens(content_utils.srt_file_to_txt_content(None, cues=cues))
+            print("Cleanup prompt tokens {} -> {}: {}".format(before, after, srt_fp))
+            report.count("Prompt tokens before cleanup", before)
+            report.count("Prompt tokens after cleanup", after)
+
+        if self.extract_tokens:
+            before = content_utils.estimate_tokens(content_utils.srt_file_to_txt_content(None, cues=cues))
+            if before > self.extract_tokens:
+                cues = content_utils.extract_cues(cues, self.extract_tokens)
+                after = content_utils.estimate_tokens(content_utils.srt_file_to_txt_content(None, cues=cues))
+                print("Extract prompt tokens {} -> {} ({:.1%}): {}".format(before, after, after / before, srt_fp))
+                report.count("Extracted sources")
+                report.count("Extract tokens before", before)
+                report.count("Extract tokens after", after)
+
+        with self.prompt_cache_lock:
+            self.prompt_cache[srt_fp] = cues
+            while len(self.prompt_cache) > self.PROMPT_CACHE_SIZE:
+                self.prompt_cache.popitem(last=False)
+        return cues
+
+    def ask_follow_up(self, q):
+        """
+        Ask more about the same transcript, it is in cached prefix of conversation.
+        """
         print("Ask: " + q)
-        ans = self.ask(
-            "\n".join([q, content]), 
-            system_role=self.init_prompt
-        )
-        print("Ans:" + ans)
\ No newline at end of file
+        ans = self.ask(q, system_role=self.init_prompt)
+        print("Ans:" + ans)
+
+    def summarize_chunks(self, q, cues):
+        """
+        Map: summarize each chunk concurrently. Reduce: merge them into one answer in qa_list.
+        """
+        chunks = content_utils.split_cues_by_tokens(cues, self.chunk_tokens)
+        print("Ask in {} chunks: {}".format(len(chunks), q))
+
+        def summarize_chunk(i):
+            content = content_utils.srt_file_to_txt_content(None, cues=chunks[i])
+            return self.create_message(
+                [{"role": "user", "content": "\n".join([self.chunk_prompt.format(i + 1, len(chunks)), q, content])}],
+                system_role=self.init_prompt,
+            )
+
+        with ThreadPoolExecutor(max_workers=max(1, self.chunk_workers)) as executor:
+            partials = list(executor.map(summarize_chunk, range(len(chunks))))
+
+        # Follow-up questions will be answered from these partials.
+        self.context = "\n".join([self.reduce_prompt] + partials)
+
+        ans = self.ask(q, system_role=self.init_prompt)
+        print("Ans:" + ans)
@@ -1,10 +1,16 @@
 import re
 import os
+import time
+import sqlite3
+import threading
 
 from setup import ServiceSetup
 
 
 class SimpleRecorder:
+    """
+    Legacy, one stamp file for each main id, replaced by ItemRecorder.
+    """
 
     @classmethod
     def check_if_had_read(cls, proj_setup:ServiceSetup, main_id, id):
@@ -25,4 +31,108 @@ class SimpleRecorder:
             return
         with open(record_fp, 'a') as f:
             f.write(id + '\n')
-        print("Marked read: {} {}".format(main_id, id))
\ No newline at end of file
+        print("Marked read: {} {}".format(main_id, id))
+
+    @classmethod
+    def iter_records(cls, stamp_dir):
+        """
+        Yield (main_id, id, mtime) from all stamp files.
+        """
+        if not os.path.isdir(stamp_dir):
+            return
+        for main_id in os.listdir(stamp_dir):
+            record_fp = os.path.join(stamp_dir, main_id)
+            if not os.path.isfile(record_fp):
+                continue
+            mtime = os.path.getmtime(record_fp)
+            with open(record_fp, 'r') as f:
+                for l in f:
+                    id = l.strip()
+                    if id:
+                        yield main_id, id, mtime
+
+
+class ItemRecorder:
+    """
+    Processed items in SQLite, keyed by (main_id, id), lookup won't grow with history.
+    """
+
+    STATUS_DONE = "done"
+
+    # SQLite limit variables in one statement.
+    BULK_SIZE = 500
+
+    def __init__(self, proj_setup:ServiceSetup):
+        self.proj_setup = proj_setup
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(proj_setup.record_db_fp, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                main_id TEXT NOT NULL,
+                id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                ts REAL NOT NULL,
+                content_hash TEXT,
+                PRIMARY KEY (main_id, id)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self.migrate_stamp_dir()
+
+    def migrate_stamp_dir(self):
+        """
+        One shot, import stamp files of SimpleRecorder.
+        """
+        with self.lock, self.db:
+            if self.db.execute("SELECT 1 FROM meta WHERE key = 'stamp_migrated'").fetchone():
+                return
+            rows = [
+                (main_id, id, self.STATUS_DONE, mtime)
+                for main_id, id, mtime in SimpleRecorder.iter_records(self.proj_setup.stamp_dir)
+            ]
+            self.db.executemany(
+                "INSERT OR IGNORE INTO items (main_id, id, status, ts) VALUES (?, ?, ?, ?)", rows
+            )
+            self.db.execute("INSERT INTO meta (key, value) VALUES ('stamp_migrated', ?)", (str(time.time()),))
+        if rows:
+            print("Migrated {} records from: {}".format(len(rows), self.proj_setup.stamp_dir))
+
+    def get_status(self, main_id, id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT status FROM items WHERE main_id = ? AND id = ?", (main_id, id)
+            ).fetchone()
+        return row[0] if row else None
+
+    def check_if_had_read(self, main_id, id):
+        return self.get_status(main_id, id) == self.STATUS_DONE
+
+    def filter_had_read(self, main_id, ids)-> set:
+        """
+        Bulk lookup for a batch from provider, return ids had read.
+        """
+        ids = list(ids)
+        found = set()
+        with self.lock:
+            for i in range(0, len(ids), self.BULK_SIZE):
+                part = ids[i:i + self.BULK_SIZE]
+                rows = self.db.execute(
+                    "SELECT id FROM items WHERE main_id = ? AND status = ? AND id IN ({})".format(",".join("?" * len(part))),
+                    [main_id, self.STATUS_DONE] + part,
+                )
+                found.update(r[0] for r in rows)
+        return found
+
+    def mark_video_as_read(self, main_id, id, content_hash=None):
+        self.mark(main_id, id, self.STATUS_DONE, content_hash)
+        print("Marked read: {} {}".format(main_id, id))
+
+    def mark(self, main_id, id, status, content_hash=None):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO items (main_id, id, status, ts, content_hash) VALUES (?, ?, ?, ?, ?)",
+                (main_id, id, status, time.time(), content_hash),
+            )
@@ -0,0 +1,65 @@
+import threading
+
+
+class RunReport:
+    """
+    Collect counters and timings from every stage during one run, print them at the end.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def add_time(self, key, seconds):
+        with self.lock:
+            total, times = self.timings.get(key, (0.0, 0))
+            self.timings[key] = (total + seconds, times + 1)
+
+    def get(self, key, default=0):
+        with self.lock:
+            return self.counters.get(key, default)
+
+    def snapshot(self):
+        """
+        Copy of counters and timings, JSON serializable.
+        """
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timings': {key: list(value) for key, value in self.timings.items()},
+            }
+
+    def merge(self, data):
+        """
+        Add counters and timings from other process.
+        """
+        for key, value in (data.get('counters') or {}).items():
+            self.count(key, value)
+        with self.lock:
+            for key, (total, times) in (data.get('timings') or {}).items():
+                old_total, old_times = self.timings.get(key, (0.0, 0))
+                self.timings[key] = (old_total + total, old_times + times)
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timings = {}
+
+    def print_summary(self):
+        with self.lock:
+            if not self.counters and not self.timings:
+                return
+            print("===== Run Report =====")
+            for key, (total, times) in self.timings.items():
+                print("{}: {:.1f}s in {} times".format(key, total, times))
+            for key, value in self.counters.items():
+                print("{}: {}".format(key, value))
+
+
+# Shared by all stages of a run.
+report = RunReport()
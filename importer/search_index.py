@@ -0,0 +1,215 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+from setup import ServiceSetup
+from utils import content_utils
+
+
+"""
+search <query>
+
+Full text index of transcriptions in SQLite FTS5, one row for each cue, so a hit has its timestamp.
+FTS5 tokenizer keep a run of CJK chars as one token, every CJK char is split as a token before
+indexing and searching, a query of CJK words is matched as a phrase of chars.
+"""
+
+# CJK ideographs, kana and hangul.
+CJK_CHAR = re.compile(r'([\u2e80-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af])')
+
+# Link of source in journal or page: [[name]] - [Link](url)
+SOURCE_LINK = re.compile(r'\[\[([^\]]+)\]\] - \[Link\]\(([^)\s]+)\)')
+
+# Line of transcription markdown, start time is saved optionally.
+MD_CUE = re.compile(r'^- (?:(\d{2}):(\d{2}):(\d{2}) )?(.*)$')
+
+
+def segment(text):
+    return CJK_CHAR.sub(r' \1 ', text)
+
+
+def build_query(query):
+    """
+    Every word must match, CJK word as phrase of its chars.
+    """
+    terms = []
+    for word in query.split():
+        tokens = segment(word).split()
+        if tokens:
+            terms.append('"{}"'.format(" ".join(tokens).replace('"', '""')))
+    return " AND ".join(terms)
+
+
+class SearchIndex:
+
+    # Rowid of cue is doc id * CUE_SLOTS + index of cue, cues of a doc are deleted by rowid range.
+    CUE_SLOTS = 1000000
+
+    def __init__(self, proj_setup:ServiceSetup):
+        self.proj_setup = proj_setup
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(proj_setup.search_db_fp, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY,
+                doc_key TEXT NOT NULL UNIQUE,
+                graph TEXT,
+                title TEXT,
+                url TEXT,
+                md_fp TEXT,
+                mtime REAL,
+                ts REAL NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS cues USING fts5(
+                text,
+                raw UNINDEXED,
+                start_ms UNINDEXED,
+                tokenize = 'unicode61'
+            );
+        """)
+
+    def doc_key(self, graph, md_fp):
+        # Folder of date or page, and file name.
+        p = Path(md_fp)
+        return "{}:{}/{}".format(graph, p.parent.name, p.name)
+
+    def add(self, graph, md_fp, title, url, cues):
+        """
+        Replace the doc, cues: [(start_ms, text), ...], start_ms may be None.
+        """
+        key = self.doc_key(graph, md_fp)
+        mtime = os.path.getmtime(md_fp) if os.path.exists(md_fp) else None
+        with self.lock, self.db:
+            row = self.db.execute("SELECT id FROM docs WHERE doc_key = ?", (key,)).fetchone()
+            if row:
+                doc_id = row[0]
+                self.db.execute(
+                    "UPDATE docs SET title = ?, url = ?, md_fp = ?, mtime = ?, ts = ? WHERE id = ?",
+                    (title, url, md_fp, mtime, time.time(), doc_id),
+                )
+                self.db.execute(
+                    "DELETE FROM cues WHERE rowid >= ? AND rowid < ?",
+                    (doc_id * self.CUE_SLOTS, (doc_id + 1) * self.CUE_SLOTS),
+                )
+            else:
+                doc_id = self.db.execute(
+                    "INSERT INTO docs (doc_key, graph, title, url, md_fp, mtime, ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, graph, title, url, md_fp, mtime, time.time()),
+                ).lastrowid
+
+            self.db.executemany(
+                "INSERT INTO cues (rowid, text, raw, start_ms) VALUES (?, ?, ?, ?)",
+                (
+                    (doc_id * self.CUE_SLOTS + i, segment(text), text, start_ms)
+                    for i, (start_ms, text) in enumerate(cues[:self.CUE_SLOTS])
+                ),
+            )
+        return doc_id
+
+    def add_srt(self, graph, md_fp, title, url, srt_fp, cues=None):
+        cues = cues if cues is not None else content_utils.iter_cues(srt_fp)
+        return self.add(graph, md_fp, title, url, [(cue.start, cue.text) for cue in cues])
+
+    def search(self, query, limit=20):
+        """
+        Return hits ranked by bm25: [{'title', 'url', 'start_ms', 'text', 'graph', 'md_fp'}, ...]
+        """
+        match = build_query(content_utils.s_to_t_text(query, cache_dir=self.proj_setup.cache_dir))
+        if not match:
+            return []
+        with self.lock:
+            rows = self.db.execute(
+                """
+                SELECT d.title, d.url, c.start_ms, c.raw, d.graph, d.md_fp
+                FROM cues c JOIN docs d ON d.id = c.rowid / ?
+                WHERE cues MATCH ?
+                ORDER BY bm25(cues)
+                LIMIT ?
+                """,
+                (self.CUE_SLOTS, match, limit),
+            ).fetchall()
+        return [
+            {'title': title, 'url': url, 'start_ms': start_ms, 'text': text, 'graph': graph, 'md_fp': md_fp}
+            for title, url, start_ms, text, graph, md_fp in rows
+        ]
+
+    def recent_docs(self, since_ts):
+        """
+        Yield docs indexed after since_ts with whole text: {'title', 'url', 'md_fp', 'text'}
+        """
+        with self.lock:
+            docs = self.db.execute(
+                "SELECT id, title, url, md_fp FROM docs WHERE ts >= ? ORDER BY ts", (since_ts,)
+            ).fetchall()
+        for doc_id, title, url, md_fp in docs:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT raw FROM cues WHERE rowid >= ? AND rowid < ? ORDER BY rowid",
+                    (doc_id * self.CUE_SLOTS, (doc_id + 1) * self.CUE_SLOTS),
+                ).fetchall()
+            yield {'title': title, 'url': url, 'md_fp': md_fp, 'text': "\n".join(r[0] for r in rows)}
+
+    def backfill(self):
+        """
+        Index transcriptions of all graphs, skip files not changed since indexed.
+        Timestamps come from srt in audio dir if it is still there, otherwise from markdown if saved.
+        """
+        count = 0
+        for graph in self.proj_setup.graphs_config or []:
+            graph_dir = self.proj_setup.abs_path(graph.get('path'))
+            urls = self.find_source_urls(graph_dir)
+
+            for md_fp in Path(graph_dir, "transcriptions").rglob("*.md"):
+                md_fp = md_fp.as_posix()
+                if self.is_indexed(graph.get('name'), md_fp):
+                    continue
+
+                name = Path(md_fp).with_suffix("").name
+                page = Path(md_fp).parent.name
+                title = name[len(page) + 3:] if name.startswith(page + "___") else name
+
+                srt_fp = os.path.join(self.proj_setup.audio_dir, title + ".srt")
+                if os.path.exists(srt_fp):
+                    self.add_srt(graph.get('name'), md_fp, title, urls.get(name), srt_fp)
+                else:
+                    self.add(graph.get('name'), md_fp, title, urls.get(name), self.read_md_cues(md_fp))
+                count += 1
+                print("Indexed: " + md_fp)
+        return count
+
+    def is_indexed(self, graph, md_fp):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT mtime FROM docs WHERE doc_key = ?", (self.doc_key(graph, md_fp),)
+            ).fetchone()
+        return bool(row) and row[0] == os.path.getmtime(md_fp)
+
+    @classmethod
+    def find_source_urls(cls, graph_dir):
+        """
+        Name of transcription -> video url, from links in journals and pages.
+        """
+        urls = {}
+        for dir in ("journals", "pages"):
+            for fp in Path(graph_dir, dir).glob("*.md"):
+                with open(fp, 'r', encoding='utf-8') as f:
+                    for name, url in SOURCE_LINK.findall(f.read()):
+                        urls[name.split("/")[-1]] = url
+        return urls
+
+    @classmethod
+    def read_md_cues(cls, md_fp):
+        cues = []
+        with open(md_fp, 'r', encoding='utf-8') as f:
+            for l in f:
+                m = MD_CUE.match(l.rstrip("\n"))
+                if not m or not m.group(4):
+                    continue
+                start_ms = None
+                if m.group(1):
+                    start_ms = ((int(m.group(1)) * 60 + int(m.group(2))) * 60 + int(m.group(3))) * 1000
+                cues.append((start_ms, m.group(4)))
+        return cues
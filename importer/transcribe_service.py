@@ -0,0 +1,142 @@
+import os
+import json
+import copy
+import time
+import queue
+import threading
+import traceback
+import socketserver
+from collections import deque
+
+from importer import transcriber
+from importer.report import report
+
+
+"""
+serve
+
+Keep whisper models loaded between runs, importers send jobs by unix socket if it is running.
+Jobs run one by one, a model use all resources of GPU or CPU.
+"""
+
+class TranscribeService:
+
+    def __init__(self, args):
+        self.args = args
+        self.socket_fp = args.proj_setup.transcribe_socket_fp
+        self.jobs = queue.Queue()
+        self.running = None
+        self.history = deque(maxlen=50) # Timings of finished jobs.
+        self.lock = threading.Lock()
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_fp):
+            if self.is_running():
+                print("Transcribe service is already running: " + self.socket_fp)
+                return
+            os.remove(self.socket_fp) # Left by crashed service.
+
+        threading.Thread(target=self.work, daemon=True).start()
+
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                if not line:
+                    return
+                try:
+                    res = service.handle(json.loads(line))
+                except Exception as e:
+                    traceback.print_exc()
+                    res = {'ok': False, 'error': str(e)}
+                self.wfile.write((json.dumps(res, ensure_ascii=False) + "\n").encode('utf-8'))
+
+        server = socketserver.ThreadingUnixStreamServer(self.socket_fp, Handler)
+        server.daemon_threads = True
+        print("Transcribe service listening: " + self.socket_fp)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if os.path.exists(self.socket_fp):
+                os.remove(self.socket_fp)
+
+    def is_running(self):
+        try:
+            transcriber.TranscribeClient(self.socket_fp).status()
+            return True
+        except Exception:
+            return False
+
+    def handle(self, payload):
+        cmd = payload.get('cmd')
+        if cmd == 'status':
+            return self.status()
+        if cmd == 'transcribe':
+            return self.submit(payload)
+        return {'ok': False, 'error': "Unknown cmd: {}".format(cmd)}
+
+    def submit(self, payload):
+        job = {
+            'payload': payload,
+            'queued_at': time.monotonic(),
+            'done': threading.Event(),
+            'result': None,
+        }
+        self.jobs.put(job)
+        job['done'].wait()
+        return job['result']
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            payload = job['payload']
+            start = time.monotonic()
+            with self.lock:
+                self.running = {'src_fp': payload.get('src_fp'), 'started': time.time()}
+
+            print("Transcribing: " + payload.get('src_fp', ''))
+            report.reset() # Jobs run one by one, counts of this job are sent back to client.
+            try:
+                segments = transcriber.transcribe_file(self.job_args(payload), payload['src_fp'], payload.get('checkpoint_fp'))
+                result = {'ok': True, 'segments': segments, 'report': report.snapshot()}
+            except Exception as e:
+                traceback.print_exc()
+                result = {'ok': False, 'error': str(e)}
+
+            end = time.monotonic()
+            result['wait'] = start - job['queued_at']
+            result['run'] = end - start
+            with self.lock:
+                self.running = None
+                self.history.append({
+                    'src_fp': payload.get('src_fp'),
+                    'ok': result['ok'],
+                    'wait': result['wait'],
+                    'run': result['run'],
+                })
+
+            job['result'] = result
+            job['done'].set()
+
+    def job_args(self, payload):
+        """
+        Service args with options of this job.
+        """
+        args = copy.copy(self.args)
+        for key in transcriber.TranscribeClient.JOB_OPTIONS:
+            if key in payload:
+                setattr(args, key, payload[key])
+        return args
+
+    def status(self):
+        with self.lock:
+            return {
+                'ok': True,
+                'queue_depth': self.jobs.qsize(),
+                'running': self.running,
+                'jobs': list(self.history),
+            }
@@ -1,12 +1,20 @@
 import os
+import copy
+import json
+import time
+import socket
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from utils import content_utils
 from utils import file_utils
-from setup import ServiceSetup
+from utils import audio_utils
 from importer.provider import SourceInfo
+from importer.report import report
 
-import mlx_whisper
-from mlx_whisper import writers
+
+SAMPLE_RATE = 16000 # Whisper models take 16 kHz mono.
 
 
 class AudioTranscriptor():
@@ -41,59 +49,528 @@ class AudioTranscriptor():
         if not self.src_info.src_fp or not os.path.exists(self.src_info.src_fp):
             raise Exception("Source is not exists: " + str(self.src_info.src_fp))
         
-        tmp = None
-        try:
-            if not self.src_info.src_fp.endswith('.wav'):
-                tmp = file_utils.transform_to_audio(self.src_info.src_fp)
-
-            # TODO Add Whisper.cpp support.
-            self.use_mlx(
-                self.args.proj_setup,
-                tmp if tmp else self.src_info.src_fp,
-                self.src_info.srt_fp,
-                model_size=self.args.model_size,
-                lang=self.args.lang,
-            )
+        srt_fp = self.src_info.srt_fp
+        checkpoint_fp = srt_fp + ".partial.jsonl"
 
-            if tmp and os.path.exists(tmp):
-                os.remove(tmp)
+        segments = None
+        if not getattr(self.args, 'no_service', False):
+            # Model is already loaded in service if it is running.
+            segments = TranscribeClient(self.args.proj_setup.transcribe_socket_fp).transcribe(self.args, self.src_info.src_fp, checkpoint_fp)
+        if segments is None:
+            segments = transcribe_file(self.args, self.src_info.src_fp, checkpoint_fp)
 
-        except Exception as e:
-            print(e)
-            if os.path.exists(tmp):
-                os.remove(tmp)
+        for segment in segments:
+            segment['text'] = content_utils.s_to_t_text(segment['text'], cache_dir=self.args.proj_setup.cache_dir)
 
-            raise e
+        # Srt exists only when complete, otherwise it is skipped as done by next run.
+        content_utils.write_srt(segments, srt_fp + ".tmp")
+        os.replace(srt_fp + ".tmp", srt_fp)
+        if os.path.exists(checkpoint_fp):
+            os.remove(checkpoint_fp)
 
         return True
 
     def post_process(self):
-        if self.src_info.srt_fp and os.path.exists(self.src_info.srt_fp):
-            content_utils.s_to_t(self.src_info.srt_fp)
+        """
+        Text are converted to Traditional Chinese before srt written, no rewrite here.
+        """
+        pass
     
-    def use_mlx(self, proj_setup:ServiceSetup, src, srt_fp, format='srt', model_size="small", lang='zh', override=False):
-        # Use mlx framework.
 
-        model_dir = proj_setup.get_dir_for_mlx_whisper_model(model_size)
-        if not os.path.exists(model_dir):
-            raise Exception("Unkonwn model: " + str(model_dir))
-        
-        # Transcribe
-        result = mlx_whisper.transcribe(
-            src,
-            path_or_hf_repo=model_dir,
-            language=lang,
-            verbose=True,
-        )
-        writer = writers.get_writer(format, os.path.dirname(srt_fp))
-        writer(result, srt_fp)
-        
-        return False
+def transcribe_file(args, src_fp, checkpoint_fp=None)-> list[dict]:
+    """
+    Decode and transcribe in this process, also used by transcribe service.
+    checkpoint_fp: Sidecar of finished segments, a crashed run resume from where it stopped.
+    """
+    # Decode into memory, no temp wav next to source, it may be in iCloud folder.
+    start = time.monotonic()
+    audio = file_utils.decode_audio(
+        src_fp,
+        sample_rate=SAMPLE_RATE,
+        ffmpeg_cmd_fp=args.proj_setup.ffmpeg or 'ffmpeg',
+    )
+    report.add_time("Decode audio", time.monotonic() - start)
+    report.count("Temp wav MB avoided", round(audio.nbytes / 2 / 1024 / 1024, 1)) # Same as pcm_s16le wav.
+
+    region_map = None
+    if getattr(args, 'vad', False):
+        audio, region_map = skip_non_speech(args, audio, src_fp)
+
+    checkpoint = None
+    if checkpoint_fp and getattr(args, 'checkpoint_minutes', 0):
+        checkpoint = TranscribeCheckpoint(checkpoint_fp, TranscribeCheckpoint.job_key(args, src_fp, len(audio)))
+
+    segments = list(checkpoint.segments) if checkpoint else []
+    resume_at = checkpoint.until if checkpoint else 0
+    if resume_at:
+        print("Resume transcribing from {}: {}".format(content_utils.ms_to_ts(resume_at * 1000 // SAMPLE_RATE), src_fp))
+        report.count("Resumed seconds", round(resume_at / SAMPLE_RATE, 1))
+
+    chunk_threshold = getattr(args, 'chunk_threshold', 0) * 60
+    if resume_at >= len(audio):
+        pass # All committed, only srt was not written.
+    elif chunk_threshold and len(audio) > chunk_threshold * SAMPLE_RATE:
+        piece_sec = getattr(args, 'chunk_minutes', 10) * 60
+        cuts = [resume_at + cut for cut in audio_utils.find_cut_points(audio[resume_at:], SAMPLE_RATE, chunk_sec=piece_sec)]
+        for i, piece_segments in transcribe_pieces(args, audio, cuts, chunk_workers(args)):
+            segments.extend(piece_segments)
+            if checkpoint:
+                checkpoint.commit(piece_segments, until=cuts[i + 1])
+    else:
+        segments.extend(transcribe_stream(args, audio, resume_at, checkpoint))
+
+    if region_map:
+        for segment in segments:
+            segment['start'] = region_map.to_original(segment['start'])
+            segment['end'] = region_map.to_original(segment['end'], is_end=True)
+    return segments
+
+
+# Chunks overlap at both edges, so words around a cut are not lost.
+CHUNK_OVERLAP_SEC = 2.0
+
+# Rough memory of a loaded model, limit workers on small machines.
+MODEL_MEMORY_GB = {"small": 1.0, "medium": 2.5, "large": 5.0}
+
+
+def chunk_workers(args):
+    workers = getattr(args, 'chunk_workers', 0)
+    if workers:
+        return workers
+
+    workers = os.cpu_count() or 1
+    try:
+        total_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+        # Keep half of memory for others.
+        workers = min(workers, int(total_gb / 2 / MODEL_MEMORY_GB.get(args.model_size, 2.5)))
+    except (ValueError, OSError, AttributeError):
+        pass
+    return max(1, workers)
+
+
+def transcribe_pieces(args, audio, cuts, workers=1):
+    """
+    Transcribe audio between cuts, yield (i, segments) of each piece in order, so caller can commit them.
+    Pieces overlap at cuts, words are transcribed with timestamps, every word belongs to the piece which
+    owns its midpoint, so a long segment across a cut is split instead of duplicated or lost.
+    More than 1 worker transcribe pieces in process pool.
+    """
+    overlap = int(CHUNK_OVERLAP_SEC * SAMPLE_RATE)
+    n = len(audio)
+    count = len(cuts) - 1
+    if count < 1:
+        return
+    word_timestamps = count > 1
+
+    def piece(i):
+        chunk_start = max(0, cuts[i] - overlap) if count > 1 else cuts[i]
+        chunk_end = min(n, cuts[i + 1] + overlap) if count > 1 else cuts[i + 1]
+        return audio[chunk_start:chunk_end], chunk_start / SAMPLE_RATE, word_timestamps
+
+    last_word = None
+    def owned(i, piece_segments):
+        nonlocal last_word
+        own_start = cuts[i] / SAMPLE_RATE
+        own_end = cuts[i + 1] / SAMPLE_RATE if i < count - 1 else float('inf')
+        result = []
+        for segment in sorted(piece_segments, key=lambda segment: segment['start']):
+            words = segment.get('words')
+            if not words:
+                # Backend without word timestamps, whole segment by its midpoint.
+                if own_start <= (segment['start'] + segment['end']) / 2 < own_end:
+                    result.append({'start': segment['start'], 'end': segment['end'], 'text': segment['text']})
+                continue
+
+            kept = [word for word in words if own_start <= (word['start'] + word['end']) / 2 < own_end]
+            if kept and last_word and kept[0]['word'].strip() == last_word['word'].strip() \
+                    and kept[0]['start'] < last_word['end']:
+                kept = kept[1:] # Same word got by both pieces with timestamps a little off.
+            if not kept:
+                continue
+            last_word = kept[-1]
+            if len(kept) == len(words):
+                result.append({'start': segment['start'], 'end': segment['end'], 'text': segment['text']})
+            else:
+                result.append({
+                    'start': kept[0]['start'],
+                    'end': kept[-1]['end'],
+                    'text': "".join(word['word'] for word in kept).strip(),
+                })
+        return result
+
+    workers = min(workers, count)
+    if workers <= 1:
+        for i in range(count):
+            yield i, owned(i, transcribe_chunk(args, *piece(i)))
+        return
+
+    print("Transcribe in {} chunks with {} workers.".format(count, workers))
+    worker_args = copy.copy(args)
+    worker_args.chunk_threshold = 0
+
+    # Spawn, fork of a process running pipeline threads may copy locks held by them.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(transcribe_chunk, worker_args, *piece(i)) for i in range(count)]
+        try:
+            # In order, a piece is committed only after all pieces before it.
+            for i, future in enumerate(futures):
+                yield i, owned(i, future.result())
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def transcribe_stream(args, audio, start=0, checkpoint=None):
+    """
+    Transcribe audio from sample start in one pass, commit segments to checkpoint about every checkpoint_minutes
+    while backend streams them, audio is not cut. Resumed run start from end of the last committed segment.
+    """
+    offset = start / SAMPLE_RATE
+    interval = getattr(args, 'checkpoint_minutes', 0) * 60
+    committed_at = offset
+    segments = []
+    pending = []
+
+    for segment in get_backend(args).iter_transcribe(audio[start:], model_size=args.model_size, lang=args.lang):
+        segment = {'start': segment['start'] + offset, 'end': segment['end'] + offset, 'text': segment['text']}
+        segments.append(segment)
+        pending.append(segment)
+        if checkpoint and segment['end'] - committed_at >= interval:
+            until = min(len(audio), int(round(segment['end'] * SAMPLE_RATE)))
+            checkpoint.commit(pending, until=until)
+            committed_at = segment['end']
+            pending = []
+
+    if checkpoint:
+        checkpoint.commit(pending, until=len(audio))
+    return segments
+
+
+class TranscribeCheckpoint:
+    """
+    Sidecar JSON lines next to srt, first line is key of the job, then one line for each commit:
+    {"until": sample, "segments": [...]}, timestamps are of audio fed to model (after VAD).
+    Line is flushed and synced, a crash lose at most segments after the last commit.
+    """
+
+    VERSION = 1
+
+    def __init__(self, fp, key):
+        self.fp = fp
+        self.key = key
+        self.segments = []
+        self.until = 0   # Sample position all audio before is committed.
+        self.load()
+
+    @classmethod
+    def job_key(cls, args, src_fp, n_samples):
+        # Pieces from other model or VAD options can't be mixed.
+        return {
+            'version': cls.VERSION,
+            'src': os.path.basename(src_fp),
+            'samples': n_samples,
+            'speech_to_text': getattr(args, 'speech_to_text', None),
+            'model_size': getattr(args, 'model_size', None),
+            'lang': getattr(args, 'lang', None),
+            'vad': getattr(args, 'vad', False),
+            'vad_threshold_db': getattr(args, 'vad_threshold_db', None),
+            'vad_min_silence': getattr(args, 'vad_min_silence', None),
+        }
+
+    def load(self):
+        if not os.path.exists(self.fp):
+            return
+
+        valid_end = 0
+        with open(self.fp, 'rb') as f:
+            header = f.readline()
+            try:
+                key = json.loads(header).get('key')
+            except ValueError:
+                key = None
+            if key != self.key:
+                print("Checkpoint is not of this job, start over: " + self.fp)
+                f.close()
+                self.remove()
+                return
+
+            valid_end = f.tell()
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break   # Torn by crash.
+                try:
+                    piece = json.loads(line)
+                except ValueError:
+                    break
+                self.segments.extend(piece['segments'])
+                self.until = piece['until']
+                valid_end = f.tell()
+
+        # Drop torn tail, or new lines are appended after it.
+        if valid_end != os.path.getsize(self.fp):
+            with open(self.fp, 'r+b') as f:
+                f.truncate(valid_end)
+
+    def commit(self, segments, until):
+        new = not os.path.exists(self.fp)
+        with open(self.fp, 'a', encoding='utf-8') as f:
+            if new:
+                f.write(json.dumps({'key': self.key}, ensure_ascii=False) + "\n")
+            f.write(json.dumps({'until': until, 'segments': segments}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.segments.extend(segments)
+        self.until = until
+
+    def remove(self):
+        if os.path.exists(self.fp):
+            os.remove(self.fp)
+
+
+def transcribe_chunk(args, audio, offset, word_timestamps=False):
+    """
+    Run in worker process, timestamps are shifted to the timeline of whole audio.
+    """
+    segments = get_backend(args).transcribe(audio, model_size=args.model_size, lang=args.lang, word_timestamps=word_timestamps)
+    result = []
+    for segment in segments:
+        shifted = {'start': segment['start'] + offset, 'end': segment['end'] + offset, 'text': segment['text']}
+        if segment.get('words'):
+            shifted['words'] = [
+                {'start': word['start'] + offset, 'end': word['end'] + offset, 'word': word['word']}
+                for word in segment['words']
+            ]
+        result.append(shifted)
+    return result
+
+
+def skip_non_speech(args, audio, src_fp):
+    """
+    Only speech regions are fed to model, waiting screen and breaks of live stream are skipped.
+    Return joined audio and map for timestamps back to original timeline.
+    """
+    regions = audio_utils.speech_regions(
+        audio,
+        sample_rate=SAMPLE_RATE,
+        threshold_db=getattr(args, 'vad_threshold_db', None),
+        min_silence_ms=int(getattr(args, 'vad_min_silence', 1.0) * 1000),
+    )
+    region_map = audio_utils.RegionMap(regions, sample_rate=SAMPLE_RATE)
+    skipped = region_map.skipped_seconds(len(audio))
+
+    print("VAD skipped {:.1f}s of {:.1f}s: {}".format(skipped, len(audio) / SAMPLE_RATE, src_fp))
+    report.count("VAD skipped seconds: " + os.path.basename(src_fp), round(skipped, 1))
+
+    if not regions:
+        return audio, None
+    return region_map.join(audio), region_map
+
+
+class TranscribeClient:
+    """
+    Send job to transcribe service by unix socket, one JSON line each way.
+    """
+
+    # Args which decide result, sent with job.
+    JOB_OPTIONS = [
+        'speech_to_text', 'model_size', 'lang', 'compute_type', 'cpu_threads', 'beam_size', 'batch_size',
+        'vad', 'vad_threshold_db', 'vad_min_silence',
+        'chunk_threshold', 'chunk_minutes', 'chunk_workers', 'checkpoint_minutes',
+    ]
+
+    def __init__(self, socket_fp):
+        self.socket_fp = socket_fp
+
+    def request(self, payload, timeout=None):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(self.socket_fp)
+            sock.settimeout(timeout)
+            sock.sendall((json.dumps(payload) + "\n").encode('utf-8'))
+            with sock.makefile('r', encoding='utf-8') as f:
+                line = f.readline()
+        if not line:
+            raise Exception("Transcribe service closed connection.")
+        return json.loads(line)
+
+    def transcribe(self, args, src_fp, checkpoint_fp=None):
+        """
+        Return None if service is not running, caller transcribe in process.
+        """
+        if not self.socket_fp or not os.path.exists(self.socket_fp):
+            return None
+
+        payload = {'cmd': 'transcribe', 'src_fp': os.path.abspath(src_fp)}
+        if checkpoint_fp:
+            payload['checkpoint_fp'] = os.path.abspath(checkpoint_fp)
+        for key in self.JOB_OPTIONS:
+            if hasattr(args, key):
+                payload[key] = getattr(args, key)
+
+        try:
+            res = self.request(payload)
+        except (ConnectionRefusedError, FileNotFoundError, socket.timeout) as e:
+            print("Transcribe service not available, transcribe in process: {}".format(e))
+            return None
+
+        if not res.get('ok'):
+            raise Exception("Transcribe service failed: {}".format(res.get('error')))
+
+        print("Transcribed by service: {} wait {:.1f}s, run {:.1f}s".format(src_fp, res.get('wait', 0), res.get('run', 0)))
+        report.count("Transcribed by service")
+        report.merge(res.get('report') or {}) # Decode and VAD counts are recorded in service.
+        return res['segments']
+
+    def status(self):
+        return self.request({'cmd': 'status'}, timeout=5)
 
 
 class YTTranscriptor(AudioTranscriptor):
 
     def post_process(self):
         super().post_process()
-        if self.src_info.src_fp and os.path.exists(self.src_info.src_fp):
-            os.remove(self.src_info.src_fp)
+        # Downloaded audio of any format, also left by earlier runs.
+        for fp in [self.src_info.src_fp] + self.src_info.audio_fps():
+            if fp and os.path.exists(fp):
+                os.remove(fp)
+
+
+"""
+Backends
+
+Take 16 kHz mono float32 audio, return segments [{'start': sec, 'end': sec, 'text': str}, ...].
+With word_timestamps, segments also have 'words': [{'start': sec, 'end': sec, 'word': str}, ...].
+"""
+
+class TranscribeBackend:
+
+    def __init__(self, args):
+        self.args = args
+
+    def transcribe(self, audio, model_size="small", lang='zh', word_timestamps=False)-> list[dict]:
+        """Override to implement for speech-to-text engine."""
+        return []
+
+    def iter_transcribe(self, audio, model_size="small", lang='zh', word_timestamps=False):
+        """
+        Yield segments while transcribing, override if engine can stream them, default yield all at the end.
+        """
+        yield from self.transcribe(audio, model_size=model_size, lang=lang, word_timestamps=word_timestamps)
+
+
+class MlxWhisperBackend(TranscribeBackend):
+    """
+    Apple Silicon only.
+    """
+
+    models = {} # model_dir: model
+    lock = threading.Lock()
+
+    def transcribe(self, audio, model_size="small", lang='zh', word_timestamps=False):
+        import mlx_whisper
+
+        from mlx_whisper.transcribe import ModelHolder
+
+        model_dir = self.args.proj_setup.get_dir_for_mlx_whisper_model(model_size)
+        if not os.path.exists(model_dir):
+            raise Exception("Unkonwn model: " + str(model_dir))
+
+        with self.lock:
+            # mlx_whisper only hold the last model, keep all sizes resident for long running service.
+            if model_dir in self.models and ModelHolder.model_path != model_dir:
+                ModelHolder.model, ModelHolder.model_path = self.models[model_dir], model_dir
+
+            result = mlx_whisper.transcribe(
+                audio,
+                path_or_hf_repo=model_dir,
+                language=lang,
+                word_timestamps=word_timestamps,
+                verbose=True,
+            )
+            self.models[model_dir] = ModelHolder.model
+        return result['segments']
+
+
+class FasterWhisperBackend(TranscribeBackend):
+    """
+    CTranslate2 on CPU for Linux hosts, int8 quantized weights, batched beam search.
+    """
+
+    MODEL_NAMES = {
+        "small": "small",
+        "medium": "medium",
+        "large": "large-v3",
+    }
+
+    models = {} # Loaded once per process.
+    lock = threading.Lock()
+
+    def load_model(self, model_size):
+        from faster_whisper import WhisperModel
+
+        compute_type = getattr(self.args, 'compute_type', 'int8')
+        cpu_threads = getattr(self.args, 'cpu_threads', 0)
+        key = (model_size, compute_type, cpu_threads)
+
+        with self.lock:
+            if key not in self.models:
+                model = self.MODEL_NAMES.get(model_size, model_size)
+                models_dir = self.args.proj_setup.faster_whisper_models_dir
+                if models_dir and os.path.exists(os.path.join(models_dir, model_size)):
+                    model = os.path.join(models_dir, model_size)
+
+                self.models[key] = WhisperModel(
+                    model,
+                    device="cpu",
+                    compute_type=compute_type,
+                    cpu_threads=cpu_threads,
+                )
+            return self.models[key]
+
+    def transcribe(self, audio, model_size="small", lang='zh', word_timestamps=False):
+        return list(self.iter_transcribe(audio, model_size=model_size, lang=lang, word_timestamps=word_timestamps))
+
+    def iter_transcribe(self, audio, model_size="small", lang='zh', word_timestamps=False):
+        model = self.load_model(model_size)
+        beam_size = getattr(self.args, 'beam_size', 5)
+        batch_size = getattr(self.args, 'batch_size', 8)
+
+        if batch_size > 1:
+            from faster_whisper import BatchedInferencePipeline
+            # Silero VAD cut audio into chunks up to 30s to decode in batches, it is how batching works,
+            # silence is also skipped by --vad before. Timestamp tokens split chunks into sentences,
+            # or a cue is a whole chunk.
+            segments, _ = BatchedInferencePipeline(model=model).transcribe(
+                audio, language=lang, beam_size=beam_size, batch_size=batch_size, word_timestamps=word_timestamps,
+                vad_filter=True, without_timestamps=False,
+            )
+        else:
+            # Same as mlx-whisper, silence is only skipped by --vad.
+            segments, _ = model.transcribe(
+                audio, language=lang, beam_size=beam_size, word_timestamps=word_timestamps, vad_filter=False,
+            )
+
+        for segment in segments: # Generator, transcribe while iterating.
+            print("[{} --> {}] {}".format(
+                content_utils.ms_to_ts(segment.start * 1000, sep='.'),
+                content_utils.ms_to_ts(segment.end * 1000, sep='.'),
+                segment.text,
+            ))
+            item = {'start': segment.start, 'end': segment.end, 'text': segment.text}
+            if segment.words:
+                item['words'] = [{'start': word.start, 'end': word.end, 'word': word.word} for word in segment.words]
+            yield item
+
+
+BACKENDS = {
+    "mlx-whisper": MlxWhisperBackend,
+    "faster-whisper": FasterWhisperBackend,
+}
+
+
+def get_backend(args)-> TranscribeBackend:
+    name = getattr(args, 'speech_to_text', 'mlx-whisper')
+    if name not in BACKENDS:
+        print("Speech to text {} is not supported yet, use mlx-whisper.".format(name))
+        name = "mlx-whisper"
+    return BACKENDS[name](args)
@@ -1,7 +1,12 @@
+import json
 import argparse
 
 from setup import ServiceSetup
 from importer.importer import AudioImporter, ZoomRecordImporter, YTImporter, DailyNewsImporter
+from importer.transcriber import TranscribeClient
+from importer.transcribe_service import TranscribeService
+from importer.search_index import SearchIndex
+from utils.content_utils import ms_to_ts
 
 
 def parse_args():
@@ -14,12 +19,44 @@ def parse_args():
     p.add_argument('--graph', '-g', default='NewsFeed', choices=["NewsFeed", "Trading", "Note", "Test"], help="Save to graph.")
 
     # Whisper
-    p.add_argument('--speech-to-text', '-t', default='mlx-whisper', choices=["mlx-whisper", "whisper.cpp"], help="Choose whisper models for trascribing.")
+    p.add_argument('--speech-to-text', '-t', default='mlx-whisper', choices=["mlx-whisper", "faster-whisper", "whisper.cpp"], help="Choose whisper models for trascribing, faster-whisper for Linux without GPU.")
     p.add_argument('--model-size', '-s', default="small", choices=["small", "medium", "large"], help="Choose model size.")
     p.add_argument('--lang', '-l', default='zh', help="Assign detected language for transcribing.") # TODO
+    p.add_argument('--compute-type', default='int8', help="faster-whisper: Quantization of weights, e.g. int8, int8_float32, float32.")
+    p.add_argument('--cpu-threads', type=int, default=0, help="faster-whisper: Threads for one transcription, 0 for default.")
+    p.add_argument('--beam-size', type=int, default=5, help="faster-whisper: Beam size of decoding.")
+    p.add_argument('--batch-size', type=int, default=8, help="faster-whisper: Decode segments in batches, 1 to disable.")
+    p.add_argument('--vad', action='store_true', help="Only transcribe speech regions, skip silence and waiting screens.")
+    p.add_argument('--vad-threshold-db', type=float, default=None, help="VAD: Energy threshold in dB, default is noise floor of the audio plus 12 dB.")
+    p.add_argument('--vad-min-silence', type=float, default=1.0, help="VAD: Seconds of silence to split speech regions.")
+    p.add_argument('--chunk-threshold', type=float, default=0, help="Minutes, longer audio is split at silence and transcribed in parallel processes, each loads its own model, 0 to disable.")
+    p.add_argument('--chunk-minutes', type=float, default=10, help="Minutes of each chunk.")
+    p.add_argument('--chunk-workers', type=int, default=0, help="Processes for chunks, 0 decide by cores and memory.")
+    p.add_argument('--checkpoint-minutes', type=float, default=5, help="Save finished segments about every these minutes of audio, interrupted transcription resume from there, 0 to disable. mlx-whisper return segments at the end, use --chunk-threshold to save by chunk.")
+    p.add_argument('--no-service', action='store_true', help="Transcribe in this process even if transcribe service is running.")
+
+    p.add_argument('--yt-audio-format', default='native', choices=["native", "wav"], help="YT: Keep downloaded audio stream as it is, or convert to WAV by ffmpeg.")
+    p.add_argument('--caption-langs', default="zh-Hant,zh-TW,zh-Hans,zh-CN", help="YT: Use published captions of these languages in order instead of transcribing, 'auto:<lang>' for auto generated, empty to always transcribe.")
 
     # AI
     p.add_argument('--ai-model', '-a', default="claude-3-haiku-20240307", choices=["claude-3-haiku-20240307", "claude-3-5-haiku-20241022", "claude-3-5-sonnet-20241022"], help="Only implement Anthropic.")
+    p.add_argument('--question', '-q', action='append', help="Ask about the source, repeat to ask more, the transcript is cached by AI service between questions.")
+    p.add_argument('--summary-chunk-tokens', type=int, default=20000, help="Split longer transcript into chunks of these tokens and summarize them concurrently, 0 to disable.")
+    p.add_argument('--summary-chunk-workers', type=int, default=4, help="Concurrent requests for chunks of one transcript.")
+    p.add_argument('--no-cleanup', action='store_true', help="Send transcript as it is, don't remove repeated cues, loops and fillers.")
+    p.add_argument('--filler', action='append', help="More filler word, cue of only fillers is not sent to AI, repeat to add more.")
+    p.add_argument('--extract-tokens', type=int, default=0, help="Send only most informative cues of longer transcript up to these tokens, picked on CPU, 0 to send all.")
+    p.add_argument('--no-llm-cache', action='store_true', help="Always send requests, don't read or write response cache.")
+    p.add_argument('--llm-cache-size', type=int, default=200, help="Max MB of response cache, least recently used are evicted.")
+    p.add_argument('--llm-cache-ttl', type=int, default=0, help="Days to keep cached responses, 0 keep until evicted.")
+
+    # Pipeline
+    p.add_argument('--download-workers', type=int, default=2, help="Concurrent downloads.")
+    p.add_argument('--download-fragments', type=int, default=4, help="Concurrent fragments of each download.")
+    p.add_argument('--download-rate-limit', help="Bandwidth limit of all downloads together, e.g. 500K, 4M bytes per second.")
+    p.add_argument('--transcribe-workers', type=int, default=1, help="Concurrent transcriptions, each worker load its own model.")
+    p.add_argument('--summarize-workers', type=int, default=2, help="Concurrent requests to AI model service.")
+    p.add_argument('--queue-size', type=int, default=2, help="Max items waiting between stages.")
 
 
     # Cmds
@@ -28,6 +65,14 @@ def parse_args():
     # News
     news_args = cmd.add_parser('news', help="Loop channels for lastest video.")
     news_args.add_argument('--monitor-list-path', '-p', default="./resources/channels.yml", help="Assign channels list YAML.")
+    news_args.add_argument('--scan-workers', type=int, default=8, help="Concurrent channel checking.")
+    news_args.add_argument('--scan-timeout', type=int, default=60, help="Seconds to wait for each channel.")
+    news_args.add_argument('--catch-up-days', type=int, default=3, help="Check videos posted in these days back to the last imported one, for missed runs.")
+    news_args.add_argument('--catch-up-limit', type=int, default=30, help="Max videos of listing to check for each channel.")
+    news_args.add_argument('--dedup-threshold', type=float, default=0, help="Transcripts of other channels similar over this are the same story, summarized once, e.g. 0.3, 0 to disable.")
+    news_args.add_argument('--dedup-days', type=int, default=2, help="Compare with transcriptions saved in these days.")
+    news_args.add_argument('--llm-batch', action='store_true', help="Summarize all videos by one Message Batch after transcribing, save when results come back.")
+    news_args.add_argument('--llm-batch-poll', type=int, default=30, help="Seconds between checking batch status.")
     
     # YT
     yt_args = cmd.add_parser('yt', help="Transcribe from YT video link.")
@@ -42,16 +87,55 @@ def parse_args():
     zoom_args = cmd.add_parser('zoom', help="Transcribing from Zoom record.")
     zoom_args.add_argument('src_fp', help="Source file path or directory, it will find matched file recursively.")
 
+    # Search
+    search_args = cmd.add_parser('search', help="Search transcriptions of all graphs.")
+    search_args.add_argument('query', nargs='*', help="Words must all match, Chinese words are matched as phrase.")
+    search_args.add_argument('--limit', '-n', type=int, default=20, help="Max hits.")
+    search_args.add_argument('--backfill', action='store_true', help="Index existing transcriptions of graph folders first.")
+
+    # Service
+    serve_args = cmd.add_parser('serve', help="Run transcribe service, keep models loaded for later runs.")
+    serve_args.add_argument('--status', action='store_true', help="Show queue depth and job timings of running service.")
+
     args = p.parse_args()
     args.proj_setup = ServiceSetup(args.setup)
 
     return args
 
 
+def search(args):
+    index = SearchIndex(args.proj_setup)
+    if args.backfill:
+        print("Indexed {} transcriptions.".format(index.backfill()))
+
+    query = " ".join(args.query)
+    if not query:
+        return
+
+    for hit in index.search(query, limit=args.limit):
+        start_ms = hit['start_ms']
+        url = hit['url'] or hit['md_fp']
+        if hit['url'] and start_ms is not None:
+            url += "{}t={}s".format("&" if "?" in url else "?", start_ms // 1000)
+        ts = ms_to_ts(start_ms) if start_ms is not None else "--:--:--,---"
+        print("{}  {}\n  {} ({} ms)\n  {}\n".format(ts, hit['title'], url, start_ms, hit['text']))
+
+
 def main():
 
     args = parse_args()
+
+    if args.cmd == 'serve':
+        if args.status:
+            print(json.dumps(TranscribeClient(args.proj_setup.transcribe_socket_fp).status(), indent=2, ensure_ascii=False))
+        else:
+            TranscribeService(args).serve_forever()
+        return
         
+    if args.cmd == 'search':
+        search(args)
+        return
+
     importers = {
         'audio': AudioImporter,
         'zoom': ZoomRecordImporter,
@@ -13,6 +13,7 @@ class ServiceSetup():
         self.current_graph = None
         self.ffmpeg = None
         self.whisper_cpp_dir = None
+        self.faster_whisper_models_dir = None
 
         self.load()
 
@@ -31,6 +32,22 @@ class ServiceSetup():
     def stamp_dir(self):
         return os.path.join(self.work_dir, "tmp", "stamp")
 
+    @property
+    def cache_dir(self):
+        return os.path.join(self.work_dir, "tmp", "cache")
+
+    @property
+    def transcribe_socket_fp(self):
+        return os.path.join(self.work_dir, "tmp", "transcriber.sock")
+
+    @property
+    def record_db_fp(self):
+        return os.path.join(self.work_dir, "tmp", "record.db")
+
+    @property
+    def search_db_fp(self):
+        return os.path.join(self.work_dir, "tmp", "search.db")
+
     @property
     def openai_key(self):
         return self.secret.get('OPENAI_KEY')
@@ -51,6 +68,16 @@ class ServiceSetup():
     def anthropic_key(self):
         return self.secret.get('ANTHROPIC_KEY')
 
+    @property
+    def anthropic_base_url(self):
+        # Point to a local stub for testing.
+        return self.config.get('anthropic_base_url')
+
+    @property
+    def fillers(self):
+        # More filler words removed from prompt, 'fillers' list in config.
+        return list(self.config.get('fillers') or [])
+
     @property
     def graph_dir(self):
         return self.abs_path(self.current_graph.get('path'))
@@ -83,6 +110,8 @@ class ServiceSetup():
         self.ffmpeg = self.config.get("ffmpeg")
         self.whisper_cpp_dir = self.abs_path(self.config.get("whisper_cpp_dir"))
         self.mlx_whisper_models_dir = self.abs_path(self.config.get("mlx_whisper_models_dir"))
+        # Optional, download from Hugging Face by model size if not set.
+        self.faster_whisper_models_dir = self.abs_path(self.config.get("faster_whisper_models_dir")) if self.config.get("faster_whisper_models_dir") else None
         
         self.graphs_config = self.config.get('graphs')
         self.current_graph = self.graphs_config[0]
@@ -90,6 +119,7 @@ class ServiceSetup():
         self.make_sure_dir_exists([
             self.audio_dir,
             self.stamp_dir,
+            self.cache_dir,
         ])
     
     def make_sure_dir_exists(self, dirs):
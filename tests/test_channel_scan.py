@@ -0,0 +1,88 @@
+import time
+import threading
+from types import SimpleNamespace
+
+from importer.provider import YTChannelsLatestVideoProvider
+
+
+release = threading.Event()
+
+
+class FakeYoutubeDL:
+    """
+    Flat listing by username: 'slow' hangs until released, 'broken' raises, 'late*' take a moment,
+    others have one fresh video.
+    """
+
+    def __init__(self, opts):
+        self.params = opts
+
+    def extract_info(self, url, download=False, process=True):
+        username = url.split("@")[1].split("/")[0]
+        if username == "slow":
+            release.wait(30)
+            return None
+        if username == "broken":
+            raise Exception("HTTP Error 500")
+        if username.startswith("late"):
+            time.sleep(0.2)
+        return {
+            'channel_id': "UC" + username,
+            'uploader': username,
+            'entries': iter([{
+                'id': username + "-1",
+                'url': "https://www.youtube.com/watch?v=" + username + "-1",
+                'title': "News of " + username,
+                'timestamp': time.time() - 3600,
+            }]),
+        }
+
+
+def make_provider(tmp_path, usernames, scan_timeout=60):
+    monitor_fp = tmp_path / "channels.yml"
+    monitor_fp.write_text("".join(
+        "- username: {0}\n  channel_name: {0}\n".format(name) for name in usernames
+    ))
+    args = SimpleNamespace(
+        monitor_list_path=str(monitor_fp),
+        scan_workers=4,
+        scan_timeout=scan_timeout,
+        proj_setup=SimpleNamespace(audio_dir=str(tmp_path)),
+    )
+    provider = YTChannelsLatestVideoProvider(args)
+    provider.ydl_cls = FakeYoutubeDL
+    return provider
+
+
+def test_failed_channel_does_not_stop_others(tmp_path):
+    provider = make_provider(tmp_path, ["a", "broken", "b"])
+
+    titles = sorted(src.title for src in provider.get_info())
+
+    assert titles == ["News of a", "News of b"]
+
+
+def test_slow_channel_is_skipped_after_timeout(tmp_path):
+    release.clear()
+    provider = make_provider(tmp_path, ["slow", "a"], scan_timeout=1)
+    try:
+        start = time.monotonic()
+        titles = [src.title for src in provider.get_info()]
+        elapsed = time.monotonic() - start
+    finally:
+        release.set()
+
+    assert titles == ["News of a"]
+    assert elapsed < 5
+
+
+def test_channels_done_while_consumer_is_slow_are_kept(tmp_path):
+    names = ["a", "late-b", "late-c", "late-d", "late-e", "late-f"]
+    provider = make_provider(tmp_path, names, scan_timeout=0.5)
+
+    titles = []
+    for src in provider.get_info():
+        titles.append(src.title)
+        time.sleep(0.6) # Pipeline queue is full, others finish meanwhile.
+
+    assert sorted(titles) == ["News of " + name for name in names]
@@ -0,0 +1,135 @@
+from types import SimpleNamespace
+
+from importer.data_setup import YTChannalSrcInfo
+from importer.dedup import StoryDeduper
+from importer.importer import DailyNewsImporter
+from utils import content_utils
+
+
+STORY = "央行今天宣布升息半碼，重貼現率調升至百分之二點二五，市場預期房貸利率將隨之上升，股市早盤應聲下跌超過百點，金融股逆勢走高。"
+OTHER = "颱風明天清晨登陸東部，氣象署發布海上陸上警報，各縣市將視雨量宣布停班停課，鐵路與航班可能大規模取消，民眾應提早準備防颱物資。"
+
+
+class FakeOutput:
+
+    def __init__(self):
+        self.saved = [] # (url, qa_list)
+        self.committed = 0
+
+    def transcription_link(self, srt_fp, page=None):
+        return "[[{}]]".format(srt_fp)
+
+    def save_summary_under_daily_with_url(self, qa_list, url, srt_fp, cues=None):
+        self.saved.append((url, qa_list))
+
+    def commit(self):
+        self.committed += 1
+
+
+class FakeRecorder:
+
+    def __init__(self):
+        self.read = []
+
+    def mark_video_as_read(self, main_id, id, content_hash=None):
+        self.read.append(id)
+
+
+def make_src(tmp_path, channel, video_id, text):
+    src = YTChannalSrcInfo(
+        str(tmp_path),
+        {'username': channel, 'channel_name': channel, 'question': "摘要"},
+        channel_info={'channel_id': channel, 'uploader': channel},
+        entry={'id': video_id, 'url': "https://www.youtube.com/watch?v=" + video_id, 'title': video_id},
+    )
+    content_utils.write_srt([{'start': 0.0, 'end': 30.0, 'text': text}], src.srt_fp)
+    return src
+
+
+def make_importer(threshold=0.3):
+    importer = DailyNewsImporter.__new__(DailyNewsImporter)
+    importer.args = SimpleNamespace(page=None, question=None)
+    importer.output_helper = FakeOutput()
+    importer.recorder = FakeRecorder()
+    importer.deduper = StoryDeduper(threshold)
+    importer.deferred = []
+    importer.saved = []
+    importer.batch = None
+    return importer
+
+
+def summarized(src):
+    src.qa_list = [("摘要", "- 重點")]
+    return src
+
+
+def test_duplicate_found_after_first_passed_save_is_linked(tmp_path):
+    importer = make_importer()
+    first = make_src(tmp_path, "cna", "v1", STORY)
+    later = make_src(tmp_path, "tvbs", "v2", STORY + "記者現場報導。")
+
+    # First one is through save stage before the later one is compared.
+    importer.save_stage(summarized(importer.dedup_stage(first)))
+    importer.save_stage(importer.summarize_stage(importer.dedup_stage(later)))
+    assert importer.output_helper.saved == []
+
+    importer.commit_output()
+
+    saved = dict(importer.output_helper.saved)
+    assert "v2" in saved[first.video_url][-1][1]
+    assert "v1" in saved[later.video_url][0][1]
+    assert importer.recorder.read == ["v1", "v2"]
+
+
+def test_episodes_of_same_channel_are_not_duplicates(tmp_path):
+    importer = make_importer()
+    intro = "歡迎收看今日新聞，本節目由贊助商冠名播出，記得訂閱按讚開啟小鈴鐺。"
+    yesterday = make_src(tmp_path, "cna", "v1", intro + STORY + intro)
+    today = make_src(tmp_path, "cna", "v2", intro + OTHER + intro)
+    other_channel = make_src(tmp_path, "tvbs", "v3", STORY)
+
+    assert importer.dedup_stage(yesterday).duplicate_of is None
+    assert importer.dedup_stage(today).duplicate_of is None
+    assert importer.dedup_stage(other_channel).duplicate_of['url'] == yesterday.video_url
+
+
+def test_history_of_same_channel_is_not_compared():
+    deduper = StoryDeduper(0.3)
+    deduper.add({'title': "cna - 昨日新聞", 'url': "u1", 'link': "[[a]]"}, STORY)
+
+    match, score = deduper.match({'title': "cna - 今日新聞", 'url': "u2", 'link': "[[b]]"}, STORY)
+
+    assert match is None
+
+
+def test_duplicate_of_failed_original_is_summarized(tmp_path):
+    importer = make_importer()
+    importer.summarize = lambda src, ans=None: summarized(src)
+    first = make_src(tmp_path, "cna", "v1", STORY)
+    later = make_src(tmp_path, "tvbs", "v2", STORY + "記者現場報導。")
+
+    # Summarize of the first one failed, pipeline dropped it.
+    importer.dedup_stage(first)
+    importer.save_stage(importer.summarize_stage(importer.dedup_stage(later)))
+    assert later.duplicate_of is not None
+
+    importer.commit_output()
+
+    assert importer.output_helper.saved == [(later.video_url, [("摘要", "- 重點")])]
+    assert importer.recorder.read == ["v2"]
+
+
+def test_duplicate_is_not_marked_read_if_its_summarize_fails(tmp_path):
+    importer = make_importer()
+    def fail(src, ans=None):
+        raise Exception("overloaded")
+    importer.summarize = fail
+    first = make_src(tmp_path, "cna", "v1", STORY)
+    later = make_src(tmp_path, "tvbs", "v2", STORY + "記者現場報導。")
+
+    importer.dedup_stage(first)
+    importer.save_stage(importer.summarize_stage(importer.dedup_stage(later)))
+    importer.commit_output()
+
+    assert importer.output_helper.saved == []
+    assert importer.recorder.read == []
@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+from importer import provider
+from importer.provider import DownloadManager
+
+
+MB = 1024 * 1024
+
+
+def hook(manager, n, fn="a.webm.part"):
+    manager.throttle({'status': "downloading", 'tmpfilename': fn, 'downloaded_bytes': n})
+
+
+def test_resumed_bytes_are_not_throttled(monkeypatch):
+    slept = []
+    monkeypatch.setattr(provider.time, 'sleep', slept.append)
+    manager = DownloadManager(SimpleNamespace(download_rate_limit="1M"))
+
+    # .part of 50MB left by crashed run, then 2MB downloaded now.
+    hook(manager, 50 * MB)
+    assert slept == []
+
+    hook(manager, 51 * MB)
+    hook(manager, 52 * MB)
+    assert 0 < sum(slept) <= 2.0
+
+
+def test_rate_is_shared_by_downloads(monkeypatch):
+    slept = []
+    monkeypatch.setattr(provider.time, 'sleep', slept.append)
+    manager = DownloadManager(SimpleNamespace(download_rate_limit="1M"))
+
+    for fn in ["a.part", "b.part", "c.part"]:
+        hook(manager, 0, fn)
+    for fn in ["a.part", "b.part", "c.part"]:
+        hook(manager, 2 * MB, fn)
+
+    # 6MB at 1MB/s, less the burst allowance.
+    assert sum(slept) >= 6.0 - DownloadManager.BURST_SEC - 0.1
@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+from importer.questioner import ClaudeQuestioner, ClaudeBatch
+from importer.importer import DailyNewsImporter
+
+
+class FakeBatches:
+    """
+    Message Batches: answer is the last prompt upper cased, results come back out of order, failed ones are errored.
+    """
+
+    def __init__(self, failed=()):
+        self.failed = set(failed)
+        self.requests = None
+        self.retrieved = 0
+
+    def create(self, requests):
+        self.requests = requests
+        return SimpleNamespace(id="batch-1", processing_status="in_progress")
+
+    def retrieve(self, batch_id):
+        self.retrieved += 1
+        return SimpleNamespace(id=batch_id, processing_status="ended")
+
+    def results(self, batch_id):
+        for request in reversed(self.requests):
+            custom_id = request['custom_id']
+            if custom_id in self.failed:
+                yield SimpleNamespace(custom_id=custom_id, result=SimpleNamespace(type="errored"))
+                continue
+            prompt = request['params']['messages'][-1]['content']
+            message = SimpleNamespace(content=[SimpleNamespace(text=prompt.upper())], usage=None)
+            yield SimpleNamespace(custom_id=custom_id, result=SimpleNamespace(type="succeeded", message=message))
+
+
+def make_batch(failed=()):
+    questioner = ClaudeQuestioner(SimpleNamespace(), SimpleNamespace(no_llm_cache=True))
+    questioner.chat = SimpleNamespace(messages=SimpleNamespace(batches=FakeBatches(failed)))
+    return ClaudeBatch(questioner, poll_interval=0)
+
+
+def params(prompt):
+    return {'model': "m", 'max_tokens': 10, 'messages': [{'role': "user", 'content': prompt}]}
+
+
+def test_results_map_back_to_requests():
+    batch = make_batch()
+    ids = [batch.add(params(prompt)) for prompt in ["a", "b", "c"]]
+
+    answers = batch.run()
+
+    assert [answers[custom_id] for custom_id in ids] == ["A", "B", "C"]
+
+
+def test_failed_entry_does_not_lose_others():
+    batch = make_batch(failed=["req-1"])
+    ids = [batch.add(params(prompt)) for prompt in ["a", "b", "c"]]
+
+    answers = batch.run()
+
+    assert answers == {ids[0]: "A", ids[2]: "C"}
+
+
+def test_finish_saves_every_item_and_falls_back_for_failed():
+    importer = DailyNewsImporter.__new__(DailyNewsImporter)
+    importer.batch = make_batch(failed=["req-1"])
+    importer.batch_items = [
+        (SimpleNamespace(name=prompt), importer.batch.add(params(prompt))) for prompt in ["a", "b", "c"]
+    ]
+
+    saved = []
+    importer.summarize = lambda src, ans=None: (src, ans if ans is not None else "sync " + src.name)
+    importer.save_stage = saved.append
+
+    importer.finish()
+
+    assert [(src.name, ans) for src, ans in saved] == [("a", "A"), ("b", "sync b"), ("c", "C")]
+    assert importer.batch_items == []
@@ -0,0 +1,39 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from importer.llm_cache import LLMCache
+
+
+def test_overwrite_is_counted_once(tmp_path):
+    cache = LLMCache(str(tmp_path), max_bytes=10 * 1024 * 1024)
+    key = cache.key(model="m", messages=["q"])
+
+    cache.set(key, "a" * 100)
+    cache.set("other", "b")
+    for _ in range(5):
+        cache.set(key, "a" * 100)
+
+    assert cache.total_bytes == sum(size for _, size, _ in cache.entries())
+
+
+def test_concurrent_writers_of_same_key(tmp_path):
+    cache = LLMCache(str(tmp_path))
+    key = cache.key(model="m", messages=["q"])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: cache.set(key, "ans {}".format(i)), range(64)))
+
+    assert cache.get(key).startswith("ans ")
+    assert os.listdir(str(tmp_path)) == [key + ".json"]
+
+
+def test_entry_evicted_after_read_is_still_a_hit(tmp_path, monkeypatch):
+    cache = LLMCache(str(tmp_path))
+    key = cache.key(model="m", messages=["q"])
+    cache.set(key, "ans")
+
+    def evicted(fp, *args, **kwargs):
+        raise FileNotFoundError(fp)
+    monkeypatch.setattr(os, 'utime', evicted)
+
+    assert cache.get(key) == "ans"
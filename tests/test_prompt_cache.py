@@ -0,0 +1,69 @@
+import json
+from types import SimpleNamespace
+
+from importer.questioner import ClaudeQuestioner
+from importer.report import report
+
+
+class FakeMessages:
+    """
+    Prompt cache of AI service: prefix up to the last cache_control block is written once, read by later calls.
+    """
+
+    def __init__(self):
+        self.cached = set()
+        self.calls = []
+
+    def create(self, **params):
+        self.calls.append(params)
+        prefix = None
+        blocks = []
+        for message in params['messages']:
+            content = message['content']
+            for block in content if isinstance(content, list) else [{"type": "text", "text": content}]:
+                blocks.append(block)
+                if "cache_control" in block:
+                    prefix = json.dumps(blocks, sort_keys=True)
+
+        usage = SimpleNamespace(input_tokens=10, cache_read_input_tokens=0, cache_creation_input_tokens=0)
+        if prefix in self.cached:
+            usage.cache_read_input_tokens = 1000
+        elif prefix:
+            self.cached.add(prefix)
+            usage.cache_creation_input_tokens = 1000
+        return SimpleNamespace(
+            content=[SimpleNamespace(text="ans {}".format(len(self.calls)))],
+            usage=usage,
+        )
+
+
+def make_questioner():
+    questioner = ClaudeQuestioner(SimpleNamespace(), SimpleNamespace(no_llm_cache=True))
+    questioner.chat = SimpleNamespace(messages=FakeMessages())
+    questioner.model = "claude-3-5-haiku-20241022"
+    questioner.context = "逐字稿" * 1000
+    return questioner
+
+
+def test_follow_up_reads_cached_transcript():
+    report.reset()
+    questioner = make_questioner()
+    questioner.cache_context = True
+
+    questioner.ask("摘要")
+    assert report.get("LLM prompt cache write tokens") == 1000
+    assert report.get("LLM prompt cache read tokens") == 0
+
+    questioner.ask("投資標的")
+    assert report.get("LLM prompt cache write tokens") == 1000
+    assert report.get("LLM prompt cache read tokens") == 1000
+
+
+def test_single_question_is_not_cached():
+    report.reset()
+    questioner = make_questioner()
+
+    questioner.ask("摘要")
+
+    assert "cache_control" not in json.dumps(questioner.chat.messages.calls[0]['messages'])
+    assert report.get("LLM prompt cache write tokens") == 0
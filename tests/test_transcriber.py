@@ -0,0 +1,300 @@
+import sys
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from importer import transcriber
+from importer.report import report
+from importer.data_setup import SourceInfo
+from importer.transcribe_service import TranscribeService
+from utils import audio_utils
+from utils import content_utils
+from utils import file_utils
+
+
+SR = transcriber.SAMPLE_RATE
+
+
+def speech(seconds, freq=440.0):
+    t = np.arange(int(seconds * SR), dtype=np.float32) / SR
+    return (0.3 * np.sin(2 * np.pi * freq * t)).astype(np.float32)
+
+
+def silence(seconds):
+    return np.zeros(int(seconds * SR), dtype=np.float32)
+
+
+class FakeBackend(transcriber.TranscribeBackend):
+    """
+    One segment for each voiced region of audio it is given.
+    """
+
+    def transcribe(self, audio, model_size="small", lang='zh', word_timestamps=False):
+        return [
+            {'start': start / SR, 'end': end / SR, 'text': "speech {:.1f}".format(start / SR)}
+            for start, end in audio_utils.speech_regions(audio, sample_rate=SR, threshold_db=-40, min_silence_ms=500, pad_ms=0)
+        ]
+
+
+# Spoken words: a tone of 0.4s then 0.1s pause, word k is told by pitch.
+WORD_SEC = 0.4
+PAUSE_SEC = 0.1
+WORD_KINDS = 100
+
+
+def word_freq(k):
+    return 300.0 + 20.0 * (k % WORD_KINDS)
+
+
+def spoken_words(count):
+    return np.concatenate([
+        np.concatenate([speech(WORD_SEC, word_freq(k)), silence(PAUSE_SEC)]) for k in range(count)
+    ])
+
+
+class FakeWordBackend(transcriber.TranscribeBackend):
+    """
+    Recognize words by pitch, group every 40 words into one segment of about 20s as Whisper does for fluent speech.
+    """
+
+    WORDS_PER_SEGMENT = 40
+
+    def transcribe(self, audio, model_size="small", lang='zh', word_timestamps=False):
+        words = []
+        for start, end in audio_utils.speech_regions(
+                audio, sample_rate=SR, frame_ms=10, threshold_db=-40, min_speech_ms=50, min_silence_ms=50, pad_ms=0):
+            voiced = np.flatnonzero(audio[start:end]) + start
+            start, end = voiced[0], voiced[-1] + 1
+            crossings = np.count_nonzero(np.diff(np.signbit(audio[start:end])))
+            k = int(round((crossings / 2 / ((end - start) / SR) - 300.0) / 20.0))
+            words.append({'start': start / SR, 'end': end / SR, 'word': " w{}".format(k)})
+
+        segments = []
+        for i in range(0, len(words), self.WORDS_PER_SEGMENT):
+            group = words[i:i + self.WORDS_PER_SEGMENT]
+            segment = {
+                'start': group[0]['start'],
+                'end': group[-1]['end'],
+                'text': "".join(word['word'] for word in group).strip(),
+            }
+            if word_timestamps:
+                segment['words'] = group
+            segments.append(segment)
+        return segments
+
+
+class KilledBackend(FakeWordBackend):
+    """
+    Stream segments, the process is killed after kill_after of them, or run to the end if None.
+    """
+
+    kill_after = None
+    given_seconds = []
+
+    def iter_transcribe(self, audio, model_size="small", lang='zh', word_timestamps=False):
+        self.given_seconds.append(len(audio) / SR)
+        for i, segment in enumerate(self.transcribe(audio, model_size=model_size, lang=lang)):
+            if self.kill_after is not None and i == self.kill_after:
+                raise KeyboardInterrupt()
+            yield segment
+
+
+@pytest.fixture
+def fake_audio(monkeypatch):
+    """
+    Decoded audio of any file is the given array, backend is the fake.
+    """
+    audio = {}
+    monkeypatch.setitem(transcriber.BACKENDS, "fake", FakeBackend)
+    monkeypatch.setitem(transcriber.BACKENDS, "fake-words", FakeWordBackend)
+    monkeypatch.setitem(transcriber.BACKENDS, "killed", KilledBackend)
+    monkeypatch.setattr(file_utils, 'decode_audio', lambda src_fp, **kwargs: audio['data'].copy())
+    return audio
+
+
+def make_args(tmp_path, **kwargs):
+    args = SimpleNamespace(
+        proj_setup=SimpleNamespace(
+            ffmpeg=None,
+            transcribe_socket_fp=str(tmp_path / "transcriber.sock"),
+            cache_dir=str(tmp_path / "cache"),
+        ),
+        speech_to_text="fake",
+        model_size="small",
+        lang="zh",
+    )
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def test_end_on_region_boundary_maps_to_end_of_region():
+    region_map = audio_utils.RegionMap([(0, 2 * SR), (5 * SR, 7 * SR)], sample_rate=SR)
+
+    assert region_map.to_original(2.0) == 5.0
+    assert region_map.to_original(2.0, is_end=True) == 2.0
+    assert region_map.to_original(4.0, is_end=True) == 7.0
+    assert region_map.to_original(1.0, is_end=True) == 1.0
+
+
+def test_vad_timestamps_on_original_timeline(tmp_path, fake_audio):
+    fake_audio['data'] = np.concatenate([speech(2), silence(3), speech(2)])
+
+    regions = audio_utils.speech_regions(fake_audio['data'], sample_rate=SR, min_silence_ms=1000)
+
+    segments = transcriber.transcribe_file(make_args(tmp_path, vad=True, vad_min_silence=1.0), "a.wav")
+
+    # Joined audio is one segment, its end is the end of the last region, not the start of a next one.
+    assert [(s['start'], s['end']) for s in segments] == [(regions[0][0] / SR, regions[-1][1] / SR)]
+
+
+def test_service_sends_job_report_back(tmp_path, fake_audio):
+    fake_audio['data'] = np.concatenate([speech(2), silence(3), speech(2)])
+    args = make_args(tmp_path, vad=True, vad_min_silence=1.0)
+    service = TranscribeService(args)
+    threading.Thread(target=service.work, daemon=True).start()
+
+    res = service.handle({'cmd': 'transcribe', 'src_fp': "a.wav", 'vad': True})
+
+    assert res['ok']
+    assert res['report']['counters']["VAD skipped seconds: a.wav"] > 2
+    assert res['report']['timings']["Decode audio"][1] == 1
+
+
+def test_client_merges_service_report(tmp_path, monkeypatch):
+    sock_fp = tmp_path / "transcriber.sock"
+    sock_fp.touch()
+    client = transcriber.TranscribeClient(str(sock_fp))
+    monkeypatch.setattr(client, 'request', lambda payload, timeout=None: {
+        'ok': True,
+        'segments': [],
+        'report': {'counters': {"VAD skipped seconds: a.wav": 3.0}, 'timings': {"Decode audio": [0.5, 1]}},
+    })
+    report.reset()
+
+    client.transcribe(make_args(tmp_path), "a.wav")
+    client.transcribe(make_args(tmp_path), "a.wav")
+
+    assert report.get("VAD skipped seconds: a.wav") == 6.0
+    assert report.get("Transcribed by service") == 2
+    assert report.snapshot()['timings']["Decode audio"] == [1.0, 2]
+
+
+def test_long_segments_across_chunk_cuts_are_stitched(tmp_path, fake_audio):
+    count = 600 # 5 minutes.
+    fake_audio['data'] = spoken_words(count)
+    args = make_args(tmp_path, speech_to_text="fake-words", chunk_threshold=1, chunk_minutes=1, chunk_workers=1)
+
+    segments = transcriber.transcribe_file(args, "a.wav")
+
+    # Every word once and in order, though segments of 20s cross the cuts.
+    assert len(segments) > count // FakeWordBackend.WORDS_PER_SEGMENT
+    words = " ".join(segment['text'] for segment in segments).split()
+    assert words == ["w{}".format(k % WORD_KINDS) for k in range(count)]
+    starts = [segment['start'] for segment in segments]
+    assert starts == sorted(starts)
+
+
+def test_killed_transcription_resumes_from_checkpoint(tmp_path, fake_audio, monkeypatch):
+    count = 600 # 5 minutes, a segment is 20s.
+    fake_audio['data'] = spoken_words(count)
+    src_fp = tmp_path / "a.wav"
+    src_fp.touch()
+    args = make_args(tmp_path, speech_to_text="killed", checkpoint_minutes=0.5, no_service=True)
+    monkeypatch.setattr(KilledBackend, 'given_seconds', [])
+
+    # Killed after 7 segments, saved every 40s of audio by then.
+    monkeypatch.setattr(KilledBackend, 'kill_after', 7)
+    with pytest.raises(KeyboardInterrupt):
+        transcriber.AudioTranscriptor(args).start_transcribe(SourceInfo(str(src_fp)))
+    src = SourceInfo(str(src_fp))
+    assert not src.is_srt_exists()
+    checkpoint_fp = src.srt_fp + ".partial.jsonl"
+    with open(checkpoint_fp, 'a') as f:
+        f.write('{"until": 999') # Torn by the kill.
+
+    monkeypatch.setattr(KilledBackend, 'kill_after', None)
+    assert transcriber.AudioTranscriptor(args).start_transcribe(src)
+
+    # Second run only transcribed audio after the 6 committed segments, whole transcript is complete.
+    assert KilledBackend.given_seconds[0] == pytest.approx(count * 0.5, abs=0.01)
+    assert KilledBackend.given_seconds[1] == pytest.approx((count - 6 * 40) * 0.5, abs=0.2)
+    words = " ".join(cue.text for cue in content_utils.read_cues(src.srt_fp)).split()
+    assert words == ["w{}".format(k % WORD_KINDS) for k in range(count)]
+    assert not (tmp_path / "a.srt.partial.jsonl").exists()
+
+
+def test_checkpoint_does_not_cut_audio(tmp_path, fake_audio, monkeypatch):
+    fake_audio['data'] = spoken_words(600)
+    args = make_args(tmp_path, speech_to_text="killed", checkpoint_minutes=0.5)
+    monkeypatch.setattr(KilledBackend, 'kill_after', None)
+    monkeypatch.setattr(KilledBackend, 'given_seconds', [])
+
+    with_checkpoint = transcriber.transcribe_file(args, "a.wav", str(tmp_path / "a.srt.partial.jsonl"))
+    without = transcriber.transcribe_file(make_args(tmp_path, speech_to_text="killed"), "a.wav")
+
+    assert len(KilledBackend.given_seconds) == 2
+    assert with_checkpoint == without
+
+
+class FakeFasterWhisper:
+    """
+    faster_whisper module: a sentence every 3s. Batched pipeline decode chunks of 30s, without timestamp tokens
+    a chunk is one segment, as the real one does by default.
+    """
+
+    calls = []
+
+    class WhisperModel:
+
+        def __init__(self, model, **kwargs):
+            pass
+
+        def transcribe(self, audio, **kwargs):
+            FakeFasterWhisper.calls.append(('sequential', kwargs))
+            return FakeFasterWhisper.sentences(0.0, len(audio) / SR), None
+
+    class BatchedInferencePipeline:
+
+        def __init__(self, model):
+            pass
+
+        def transcribe(self, audio, without_timestamps=True, **kwargs):
+            FakeFasterWhisper.calls.append(('batched', dict(kwargs, without_timestamps=without_timestamps)))
+            segments = []
+            total = len(audio) / SR
+            for start in np.arange(0.0, total, 30.0):
+                end = min(total, start + 30.0)
+                if without_timestamps:
+                    segments.append(SimpleNamespace(start=start, end=end, text="chunk", words=None))
+                else:
+                    segments.extend(FakeFasterWhisper.sentences(start, end))
+            return iter(segments), None
+
+    @classmethod
+    def sentences(cls, start, end):
+        return [
+            SimpleNamespace(start=float(t), end=float(min(end, t + 3.0)), text="sentence", words=None)
+            for t in np.arange(start, end, 3.0)
+        ]
+
+
+def test_batched_cues_are_as_short_as_sequential(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'faster_whisper', FakeFasterWhisper)
+    monkeypatch.setattr(transcriber.FasterWhisperBackend, 'models', {})
+    monkeypatch.setattr(FakeFasterWhisper, 'calls', [])
+    audio = silence(95)
+
+    def cues(batch_size):
+        args = make_args(tmp_path, batch_size=batch_size)
+        args.proj_setup.faster_whisper_models_dir = None
+        return transcriber.FasterWhisperBackend(args).transcribe(audio)
+
+    batched, sequential = cues(8), cues(1)
+
+    assert [(s['start'], s['end']) for s in batched] == [(s['start'], s['end']) for s in sequential]
+    assert max(s['end'] - s['start'] for s in batched) <= 3.0
+    # Silero VAD is decided explicitly, not left to library defaults.
+    assert [(kind, kwargs['vad_filter']) for kind, kwargs in FakeFasterWhisper.calls] == [('batched', True), ('sequential', False)]
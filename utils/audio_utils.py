@@ -0,0 +1,134 @@
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+
+# ===== Voice Activity =====
+
+
+def frame_db(audio, frame_len):
+    """
+    RMS of each frame in dB, tail shorter than a frame is dropped.
+    """
+    n = len(audio) // frame_len
+    if n == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = audio[:n * frame_len].reshape(n, frame_len).astype(np.float32)
+    return 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+
+
+def speech_regions(audio, sample_rate=16000, frame_ms=30, threshold_db=None, margin_db=12.0,
+                   min_speech_ms=300, min_silence_ms=1000, pad_ms=200):
+    """
+    Energy based, return [(start_sample, end_sample), ...] of speech.
+    threshold_db: Fixed threshold, None will use noise floor of this audio plus margin_db.
+    Silence shorter than min_silence_ms is kept, so sentences are not cut.
+    """
+    frame_len = int(sample_rate * frame_ms / 1000)
+    db = frame_db(audio, frame_len)
+    if len(db) == 0:
+        return [(0, len(audio))] if len(audio) else []
+
+    if threshold_db is None:
+        # Floor of quietest 10% frames, never lower than -60 dB for digital silence.
+        threshold_db = max(np.percentile(db, 10), -60.0) + margin_db
+    voiced = db > threshold_db
+
+    # Runs of voiced frames.
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], voiced.astype(np.int8), [0]))))
+    runs = list(zip(edges[::2], edges[1::2]))
+
+    min_silence = min_silence_ms // frame_ms
+    min_speech = max(1, min_speech_ms // frame_ms)
+    pad = pad_ms // frame_ms
+
+    merged = []
+    for start, end in runs:
+        if merged and start - merged[-1][1] < min_silence:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+
+    regions = []
+    for start, end in merged:
+        if end - start < min_speech:
+            continue
+        start = int(max(0, start - pad) * frame_len)
+        end = int(min(len(db), end + pad) * frame_len)
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+
+    # Keep tail shorter than a frame with last region.
+    if regions and regions[-1][1] == len(db) * frame_len:
+        regions[-1] = (regions[-1][0], len(audio))
+    return regions
+
+
+class RegionMap:
+    """
+    Join speech regions into one audio, map time of joined audio back to original timeline.
+    """
+
+    def __init__(self, regions, sample_rate=16000):
+        self.sample_rate = sample_rate
+        self.regions = regions
+        self.joined_starts = [] # Seconds in joined audio.
+        total = 0
+        for start, end in regions:
+            self.joined_starts.append(total / sample_rate)
+            total += end - start
+        self.joined_len = total
+
+    def join(self, audio):
+        if not self.regions:
+            return audio[:0]
+        return np.concatenate([audio[start:end] for start, end in self.regions])
+
+    def to_original(self, t, is_end=False):
+        """
+        is_end: Time on boundary of regions is end of the region before, not start of the next.
+        """
+        if not self.regions:
+            return t
+        find = bisect_left if is_end else bisect_right
+        i = max(0, find(self.joined_starts, t) - 1)
+        start, end = self.regions[i]
+        orig = start / self.sample_rate + (t - self.joined_starts[i])
+        return float(min(orig, end / self.sample_rate))
+
+    def skipped_seconds(self, total_samples):
+        return (total_samples - self.joined_len) / self.sample_rate
+
+
+# ===== Split =====
+
+
+def find_cut_points(audio, sample_rate=16000, chunk_sec=600, search_sec=20, frame_ms=30):
+    """
+    Split about every chunk_sec at the quietest frame within search_sec around, return sample positions include 0 and end.
+    """
+    n = len(audio)
+    chunk_len = int(chunk_sec * sample_rate)
+    if n <= chunk_len:
+        return [0, n]
+
+    frame_len = int(sample_rate * frame_ms / 1000)
+    db = frame_db(audio, frame_len)
+    search = int(search_sec * sample_rate) // frame_len
+
+    cuts = [0]
+    target = chunk_len
+    while target < n - chunk_len // 2: # Don't leave a tiny last chunk.
+        center = target // frame_len
+        lo = max(cuts[-1] // frame_len + 1, center - search)
+        hi = min(len(db), center + search + 1)
+        if lo < hi:
+            cut = (lo + int(np.argmin(db[lo:hi]))) * frame_len + frame_len // 2
+        else:
+            cut = target
+        cuts.append(cut)
+        target = cut + chunk_len
+    cuts.append(n)
+    return cuts
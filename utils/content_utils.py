@@ -1,103 +1,341 @@
-import re
 import os
+import re
+import html
+import itertools
+
+import numpy as np
+
+from utils import zh_utils
+from utils import similarity_utils
+
+
+# ===== Parse =====
+
+
+class Cue:
+    """
+    One subtitle, start and end in milliseconds.
+    """
+    __slots__ = ('index', 'start', 'end', 'text')
+
+    def __init__(self, index, start, end, text):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.text = text
+
+    def __repr__(self):
+        return "Cue({}, {}, {}, {!r})".format(self.index, self.start, self.end, self.text)
+
+
+def ts_to_ms(ts):
+    """
+    '01:02:03,456' or '02:03.456' to milliseconds.
+    """
+    ts = ts.strip().replace(',', '.')
+    sec, _, frac = ts.partition('.')
+    ms = int((frac + '000')[:3]) if frac else 0
+    seconds = 0
+    for p in sec.split(':'):
+        seconds = seconds * 60 + int(p)
+    return seconds * 1000 + ms
+
+
+def ms_to_ts(ms, with_ms=True, sep=','):
+    s, ms = divmod(int(ms), 1000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    if not with_ms:
+        return "{:02d}:{:02d}:{:02d}".format(h, m, s)
+    return "{:02d}:{:02d}:{:02d}{}{:03d}".format(h, m, s, sep, ms)
+
+
+def parse_srt_lines(lines):
+    """
+    Stream cues from lines of srt, text of multi-line cue join with space.
+    """
+    index = None
+    start = end = None
+    text = []
+
+    for l in lines:
+        raw = l.strip().lstrip('\ufeff')
 
-from zhconv import convert
+        if raw == "":
+            if start is not None and text:
+                yield Cue(index, start, end, " ".join(text))
+            index = None
+            start = end = None
+            text = []
+
+        elif start is None:
+            if '-->' in raw:
+                s, _, e = raw.partition('-->')
+                start = ts_to_ms(s)
+                end = ts_to_ms(e.split()[0]) if e.strip() else start
+            elif raw.isdigit():
+                index = int(raw)
+
+        else:
+            text.append(raw)
+
+    if start is not None and text:
+        yield Cue(index, start, end, " ".join(text))
+
+
+VTT_TAG = re.compile(r'<[^>]*>')
+
+
+def parse_vtt_lines(lines):
+    """
+    Stream cues from WebVTT captions of YouTube, inline tags and timestamps are removed.
+    Auto captions repeat lines of last cue for rolling display, repeated lines are dropped.
+    """
+    index = 0
+    start = end = None
+    text = []
+    last = []
+
+    for l in itertools.chain(lines, [""]):
+        line = l.rstrip('\r\n').lstrip('\ufeff')
+
+        if line == "":  # Line of a space is still inside the cue.
+            if start is not None:
+                new = [t for t in text if t and t not in last]
+                if new:
+                    index += 1
+                    yield Cue(index, start, end, " ".join(new))
+                if any(text):
+                    last = text
+            start = end = None
+            text = []
+
+        elif start is None:
+            if '-->' in line:
+                s, _, e = line.partition('-->')
+                start = ts_to_ms(s)
+                end = ts_to_ms(e.split()[0]) if e.strip() else start
+
+        else:
+            text.append(html.unescape(VTT_TAG.sub('', line)).strip())
+
+
+def iter_cues(srt_fp):
+    with open(srt_fp, 'r', encoding='utf-8') as src:
+        yield from parse_srt_lines(src)
+
+
+def read_cues(srt_fp)-> list[Cue]:
+    return list(iter_cues(srt_fp))
 
 
 # ===== Format =====
 
 
-def srt_to_txt(srt_fp, txt_fp, save_start_ts=False):
+def write_srt(segments, srt_fp):
     """
-    Use srt can split sentence by transcript, that make txt more readable.
+    Segments from whisper, start and end in seconds. Same format as whisper srt writer.
     """
-    with open(srt_fp, 'r') as src, open(txt_fp, 'w') as dst:
-        start_ts = None
-        count = 0
-        for l in src.readlines():
-            raw = l.strip()
-            if raw == "":
-                count = 0
-
-            elif count == 0: # idx
-                count += 1
-
-            elif count == 1: # ts
-                if save_start_ts:
-                    start_ts = re.findall(r"\d{2}\:\d{2}\:\d{2}", raw)[0]
-                count += 1
-
-            elif count == 2: # line
-                if save_start_ts:
-                    dst.write("{} {}\n".format(start_ts, raw))
-                else:
-                    dst.write("{}\n".format(raw))
-                count = 0
+    with open(srt_fp, 'w', encoding='utf-8') as dst:
+        for i, segment in enumerate(segments, start=1):
+            dst.write("{}\n{} --> {}\n{}\n\n".format(
+                i,
+                ms_to_ts(round(segment['start'] * 1000)),
+                ms_to_ts(round(segment['end'] * 1000)),
+                segment['text'].strip().replace("-->", "->"),
+            ))
     return True
 
 
-def srt_file_to_txt_content(srt_fp):
+
+def render_lines(cues, line_format, save_start_ts=False):
+    for cue in cues:
+        if save_start_ts:
+            yield line_format.format("{} {}".format(ms_to_ts(cue.start, with_ms=False), cue.text))
+        else:
+            yield line_format.format(cue.text)
+
+
+def srt_to_txt(srt_fp, txt_fp, save_start_ts=False, cues=None):
     """
     Use srt can split sentence by transcript, that make txt more readable.
     """
-    content = []
-    with open(srt_fp, 'r') as src:
-        count = 0
-        for l in src.readlines():
-            raw = l.strip()
-            if raw == "":
-                count = 0
+    cues = cues if cues is not None else iter_cues(srt_fp)
+    with open(txt_fp, 'w') as dst:
+        dst.writelines(render_lines(cues, "{}\n", save_start_ts))
+    return True
 
-            elif count == 0: # idx
-                count += 1
 
-            elif count == 1: # ts
-                count += 1
+def srt_file_to_txt_content(srt_fp, cues=None):
+    """
+    Use srt can split sentence by transcript, that make txt more readable.
+    """
+    cues = cues if cues is not None else iter_cues(srt_fp)
+    return "\n".join(cue.text for cue in cues)
 
-            elif count == 2: # line
-                content.append(raw)
-                count = 0
 
-    return "\n".join(content)
+def srt_to_md_list_content(srt_fp, save_start_ts=False, cues=None):
+    """
+    Same as srt_to_md_list, return content instead of writing file.
+    """
+    cues = cues if cues is not None else iter_cues(srt_fp)
+    return "".join(render_lines(cues, "- {}\n", save_start_ts))
 
 
-def srt_to_md_list(srt_fp, md_fp, save_start_ts=False):
+def srt_to_md_list(srt_fp, md_fp, save_start_ts=False, cues=None):
     """
     If import txt into Logseq, that will be only 1 list item and include all content.
     Transform into markdown list format for each line will be easier to editting
     Don't need to feed AI so won't save txt.
     """
-    with open(srt_fp, 'r') as src, open(md_fp, 'w') as dst:
-        start_ts = None
-        count = 0
-        for l in src.readlines():
-            raw = l.strip()
-            if raw == "":
-                count = 0
-
-            elif count == 0: # idx
-                count += 1
-
-            elif count == 1: # ts
-                if save_start_ts:
-                    start_ts = re.findall(r"\d{2}\:\d{2}\:\d{2}", raw)[0]
-                count += 1
-
-            elif count == 2: # line
-                if save_start_ts:
-                    dst.write("- {} {}\n".format(start_ts, raw))
-                else:
-                    dst.write("- {}\n".format(raw))
-                count = 0
+    cues = cues if cues is not None else iter_cues(srt_fp)
+    with open(md_fp, 'w') as dst:
+        dst.writelines(render_lines(cues, "- {}\n", save_start_ts))
 
     return True
 
 
+# ===== Tokens =====
+
+
+def estimate_tokens(text):
+    """
+    Rough count without tokenizer, a CJK char is about 1 token, other text about 4 chars a token.
+    """
+    cjk = sum(1 for ch in text if ch >= '\u2e80')
+    return cjk + (len(text) - cjk) // 4
+
+
+def split_cues_by_tokens(cues, max_tokens):
+    """
+    Split at cue boundaries, every chunk is under max_tokens unless a single cue is larger.
+    """
+    chunks = []
+    chunk = []
+    tokens = 0
+    for cue in cues:
+        n = estimate_tokens(cue.text) + 1
+        if chunk and tokens + n > max_tokens:
+            chunks.append(chunk)
+            chunk = []
+            tokens = 0
+        chunk.append(cue)
+        tokens += n
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+# ===== Cleanup =====
+
+
+# Cue of only these words carry nothing for summary.
+FILLERS = ["嗯", "啊", "呃", "欸", "喔", "哦", "那個", "就是", "然後", "對", "好"]
+
+# Credits which whisper make up on silence or music, removed wherever they are.
+BOILERPLATE = [
+    "請不吝點讚訂閱轉發打賞支持明鏡與點點欄目",
+    "請不吝點贊訂閱轉發打賞支持明鏡與點點欄目",
+    "字幕由Amara.org社區提供",
+    "優優獨播劇場",
+    "YoYo Television Series Exclusive",
+    "中文字幕志願者",
+    "歡迎訂閱我的頻道",
+    "感謝觀看",
+    "謝謝觀看",
+]
+
+NON_WORD = re.compile(r'[\W_]+')
+
+# Same short phrase repeated in one cue, e.g. 謝謝謝謝謝謝, digits are kept for numbers like 10000.
+REPEATED_PHRASE = re.compile(r'(\D{1,10}?)\1{3,}')
+
+
+def clean_cues(cues, fillers=FILLERS, boilerplate=BOILERPLATE, max_period=4):
+    """
+    Remove noise of transcription for prompt, return new cues, the given cues are not changed.
+    Consecutive duplicates are collapsed, loop of whisper like A B A B A B keeps the first 2 rounds.
+    """
+    filler_set = {NON_WORD.sub("", f) for f in fillers if f}
+    kept = []
+    keys = [] # Normalized text of kept cues.
+
+    for cue in cues:
+        text = cue.text
+        for b in boilerplate:
+            if b:
+                text = text.replace(b, "")
+        text = REPEATED_PHRASE.sub(r'\1', text).strip()
+
+        key = NON_WORD.sub("", text)
+        if not key or key in filler_set:
+            continue
+        if keys and key == keys[-1]:
+            continue
+
+        # Cue continue a loop which already repeated once.
+        loop = False
+        for p in range(2, max_period + 1):
+            if len(keys) >= 2 * p and key == keys[-p] and keys[-p:] == keys[-2 * p:-p]:
+                loop = True
+                break
+        if loop:
+            continue
+
+        kept.append(cue if text == cue.text else Cue(cue.index, cue.start, cue.end, text))
+        keys.append(key)
+    return kept
+
+
+# ===== Extract =====
+
+
+def extract_cues(cues, max_tokens, passage_tokens=60, gap_text="……"):
+    """
+    Pick most central passages by TextRank up to max_tokens, return their cues in original order.
+    Passage is consecutive cues of about passage_tokens, a cue of gap_text marks skipped part.
+    """
+    passages = split_cues_by_tokens(cues, passage_tokens)
+    sizes = [sum(estimate_tokens(cue.text) + 1 for cue in passage) for passage in passages]
+    if sum(sizes) <= max_tokens:
+        return list(cues)
+
+    texts = [" ".join(cue.text for cue in passage) for passage in passages]
+    counts = np.vstack([similarity_utils.ngram_counts(text, dim_bits=12) for text in texts])
+    scores = similarity_utils.textrank(counts)
+
+    chosen = set()
+    total = 0
+    for i in np.argsort(-scores):
+        if total + sizes[i] > max_tokens:
+            continue
+        chosen.add(int(i))
+        total += sizes[i]
+
+    extracted = []
+    last = -1
+    for i, passage in enumerate(passages):
+        if i not in chosen:
+            continue
+        if i != last + 1 and gap_text:
+            extracted.append(Cue(None, passage[0].start, passage[0].start, gap_text))
+        extracted.extend(passage)
+        last = i
+    return extracted
+
+
 # ===== Translate =====
 
-def s_to_t(src_fp):
+def s_to_t_text(s, cache_dir=None):
     """
-    For small file, need refactoring if deal with large file.
+    Convert in memory, e.g. segments before srt is written, so no need to rewrite file later.
+    """
+    return zh_utils.get_converter('zh-tw', cache_dir=cache_dir).convert(s)
+
+
+def s_to_t(src_fp, cache_dir=None):
+    """
+    Convert file in bounded chunks.
     Save to tmp, replace original file after convertion.
     """
     if not src_fp:
@@ -105,8 +343,9 @@ def s_to_t(src_fp):
     dst_fp = src_fp + ".tmp"
 
     try:
+        converter = zh_utils.get_converter('zh-tw', cache_dir=cache_dir)
         with open(src_fp, 'r') as src, open(dst_fp, 'w') as dst:
-            dst.write(convert(src.read(), 'zh-tw'))
+            converter.convert_stream(src, dst)
 
     except Exception as e:
         print(e)
@@ -114,8 +353,6 @@ def s_to_t(src_fp):
             os.remove(dst_fp)  # If error again, it must be bigger problem.
         return False
     
-    os.remove(src_fp)
-    os.rename(dst_fp, src_fp)
+    os.replace(dst_fp, src_fp)
 
     return True
-
@@ -1,32 +1,44 @@
 import os
+import hashlib
 from pathlib import Path
 import subprocess
 
+import numpy as np
 
-# ===== Video Transform =====
-
-def transform_to_audio(src_fp, audio_format='.wav', ffmpeg_cmd_fp='ffmpeg'):
-
-    tmp_wave_fp = Path(src_fp).with_suffix(audio_format).as_posix()
-
-    if os.path.exists(tmp_wave_fp):
-        os.remove(tmp_wave_fp)
 
-    # whisper.cpp only accept .wav
-    if not os.path.exists(tmp_wave_fp):
-        subprocess.run([
-            ffmpeg_cmd_fp, 
-            "-y",
-            "-loglevel", "error",
-            "-i", src_fp,
-            "-acodec", "pcm_s16le",
-            "-ac", "1",
-            "-ar", "16000",
-            tmp_wave_fp,
-            # tmp_wave_fp.absolute().as_posix(),
-        ])
+# ===== Video Transform =====
 
-    return tmp_wave_fp
+def decode_audio(src_fp, sample_rate=16000, ffmpeg_cmd_fp='ffmpeg'):
+    """
+    Decode to 16-bit mono PCM through a pipe, return float32 samples in [-1, 1).
+    Nothing written to disk, ffmpeg is killed if anything goes wrong.
+    """
+    proc = subprocess.Popen([
+        ffmpeg_cmd_fp,
+        "-nostdin",
+        "-loglevel", "error",
+        "-i", src_fp,
+        "-f", "s16le",
+        "-acodec", "pcm_s16le",
+        "-ac", "1",
+        "-ar", str(sample_rate),
+        "-",
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    try:
+        out, err = proc.communicate()
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    if proc.returncode != 0:
+        raise Exception("Decode audio failed: {} {}".format(src_fp, err.decode(errors='ignore').strip()))
+
+    # Scale in place, no second full size array.
+    audio = np.frombuffer(out, np.int16).astype(np.float32)
+    audio /= 32768.0
+    return audio
 
 
 # ===== File Util =====
@@ -58,4 +70,14 @@ def make_dirs_for_fp(fp):
     parent_dir = Path(fp).parent.as_posix() 
     if os.path.exists(parent_dir) and os.path.isdir(parent_dir):
         return
-    os.makedirs(parent_dir)
\ No newline at end of file
+    os.makedirs(parent_dir)
+
+
+def hash_file(fp, block_size=1 << 20):
+    if not fp or not os.path.exists(fp):
+        return None
+    h = hashlib.sha1()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
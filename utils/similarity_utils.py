@@ -0,0 +1,83 @@
+import re
+
+import numpy as np
+
+
+"""
+Similarity of texts by hashed char n-grams and TF-IDF, no tokenizer or model needed for Chinese.
+"""
+
+DIM_BITS = 16
+NGRAMS = (2,) # Bigrams are close to words of Chinese, trigrams are too sparse for reworded story.
+
+NON_WORD = re.compile(r'[\W_]+')
+
+# Fibonacci hashing, spread n-gram keys over 2 ** DIM_BITS slots.
+HASH_MUL = np.uint64(0x9E3779B97F4A7C15)
+
+
+def ngram_counts(text, dim_bits=DIM_BITS, ngrams=NGRAMS):
+    """
+    Counts of char n-grams in slots, spaces and punctuation are removed first.
+    """
+    dim = 1 << dim_bits
+    counts = np.zeros(dim, dtype=np.float32)
+    text = NON_WORD.sub("", text.lower())
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+
+    for n in ngrams:
+        m = len(codes) - n + 1
+        if m <= 0:
+            continue
+        keys = np.zeros(m, dtype=np.uint64)
+        for k in range(n):
+            # Code point is under 21 bits, up to 3 chars fit in 64 bits.
+            keys = (keys << np.uint64(21)) | codes[k:k + m]
+        slots = (keys * HASH_MUL) >> np.uint64(64 - dim_bits)
+        counts += np.bincount(slots.astype(np.int64), minlength=dim).astype(np.float32)
+    return counts
+
+
+def tfidf_vectors(counts):
+    """
+    counts: (docs, dim), return L2 normalized TF-IDF rows, IDF from these docs.
+    """
+    n = len(counts)
+    tf = np.log1p(counts)
+    df = np.count_nonzero(counts, axis=0)
+    idf = np.log((1 + n) / (1 + df)) + 1
+    vectors = tf * idf.astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def similarities(counts, i):
+    """
+    Cosine similarity of doc i to every doc.
+    """
+    vectors = tfidf_vectors(counts)
+    return vectors @ vectors[i]
+
+
+def textrank(counts, damping=0.85, iters=50, tol=1e-6):
+    """
+    Centrality of each doc in graph weighted by similarity, PageRank by power iteration.
+    """
+    n = len(counts)
+    if n == 0:
+        return np.zeros(0, dtype=np.float32)
+    vectors = tfidf_vectors(counts)
+    sim = np.maximum(vectors @ vectors.T, 0)
+    np.fill_diagonal(sim, 0)
+
+    # Row without any similar doc jumps to all.
+    sums = sim.sum(axis=1, keepdims=True)
+    transition = np.where(sums > 0, sim / np.maximum(sums, 1e-12), 1.0 / n)
+
+    rank = np.full(n, 1.0 / n, dtype=np.float32)
+    for _ in range(iters):
+        new = (1 - damping) / n + damping * (transition.T @ rank)
+        if np.abs(new - rank).sum() < tol:
+            return new
+        rank = new
+    return rank
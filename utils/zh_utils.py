@@ -0,0 +1,200 @@
+import os
+import pickle
+import threading
+
+import numpy as np
+import zhconv
+from zhconv import zhconv as zhconv_dict
+
+
+"""
+Simplified to Traditional Chinese, same longest match result as zhconv.convert.
+
+zhconv walk every char in Python, it is slow for hours of transcription.
+Here all single chars are mapped by a lookup table in NumPy, and only positions which start a known
+2 chars prefix of a phrase are walked in Python, that is less than 1% of chars in common text.
+"""
+
+CACHE_VERSION = 1
+
+
+class ZhConverter:
+
+    def __init__(self, locale='zh-tw', cache_dir=None):
+        self.locale = locale
+        self.cache_dir = cache_dir
+        self.lut = None         # Code point -> converted code point.
+        self.bigrams = None     # Sorted keys of first 2 chars of phrases.
+        self.phrases = None
+        self.prefixes = None
+        self.max_len = 1
+        self.load()
+
+    @property
+    def cache_fp(self):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, "zhconv_{}_{}.pickle".format(self.locale, CACHE_VERSION))
+
+    def load(self):
+        data = self.load_cache()
+        if not data:
+            data = self.build()
+            self.save_cache(data)
+
+        self.lut = data['lut']
+        self.bigrams = data['bigrams']
+        self.phrases = data['phrases']
+        self.prefixes = data['prefixes']
+        self.max_len = data['max_len']
+
+    def dict_stamp(self):
+        # Rebuild if zhconv or its dictionary changed.
+        return "{} {}".format(getattr(zhconv, '__version__', ''), os.path.getmtime(zhconv_dict.__file__))
+
+    def load_cache(self):
+        fp = self.cache_fp
+        if not fp or not os.path.exists(fp):
+            return None
+        try:
+            with open(fp, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            print("Load conversion cache failed: {} {}".format(fp, e))
+            return None
+        if data.get('stamp') != self.dict_stamp():
+            return None
+        return data
+
+    def save_cache(self, data):
+        fp = self.cache_fp
+        if not fp:
+            return
+        tmp = fp + ".tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, fp)
+        except Exception as e:
+            print("Save conversion cache failed: {} {}".format(fp, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def build(self):
+        zhdict = zhconv_dict.getdict(self.locale)
+        chars = {}
+        phrases = {}
+        prefixes = set() # Flatten trie, all prefixes of phrases.
+        for k, v in zhdict.items():
+            if len(k) == 1:
+                chars[ord(k)] = ord(v)  # Single char always map to single char.
+            elif k:
+                phrases[k] = v
+                for i in range(2, len(k) + 1):
+                    prefixes.add(k[:i])
+
+        lut = np.arange(max(chars, default=0) + 1, dtype=np.uint32)
+        for k, v in chars.items():
+            lut[k] = v
+
+        bigrams = np.unique(np.array(
+            [self.bigram_key(ord(k[0]), ord(k[1])) for k in phrases],
+            dtype=np.uint64,
+        ))
+
+        return {
+            'stamp': self.dict_stamp(),
+            'lut': lut,
+            'bigrams': bigrams,
+            'phrases': phrases,
+            'prefixes': frozenset(prefixes),
+            'max_len': max(map(len, zhdict)) if zhdict else 1,
+        }
+
+    @classmethod
+    def bigram_key(cls, a, b):
+        # Code point is under 21 bits.
+        return (a << 21) | b
+
+    def convert(self, s):
+        return self._convert_until(s, len(s))[0]
+
+    def _convert_until(self, s, stop):
+        """
+        Convert phrases start before stop, return converted text and where it ended.
+        """
+        if not s:
+            return s, 0
+
+        codes = np.frombuffer(s.encode('utf-32-le'), dtype=np.uint32)
+
+        # Single chars, code points out of table keep the same.
+        mapped = np.where(codes < len(self.lut), self.lut[np.minimum(codes, len(self.lut) - 1)], codes)
+
+        # Positions may start a phrase.
+        wide = codes.astype(np.uint64)
+        keys = ((wide[:-1] << np.uint64(21)) | wide[1:])[:stop]
+        candidates = []
+        if len(self.bigrams) and len(keys):
+            found = np.minimum(np.searchsorted(self.bigrams, keys), len(self.bigrams) - 1)
+            candidates = np.flatnonzero(self.bigrams[found] == keys).tolist()
+
+        n = len(s)
+        converted = mapped.tobytes().decode('utf-32-le')
+        parts = []
+        pos = 0
+        for i in candidates:
+            if i < pos:
+                continue  # Inside last phrase.
+
+            # Longest phrase start from i.
+            best = 0
+            j = i + 2
+            while j <= n and s[i:j] in self.prefixes:
+                if s[i:j] in self.phrases:
+                    best = j
+                j += 1
+
+            if best:
+                parts.append(converted[pos:i])
+                parts.append(self.phrases[s[i:best]])
+                pos = best
+
+        end = max(pos, stop)
+        parts.append(converted[pos:end])
+        return "".join(parts), end
+
+    def convert_stream(self, src, dst, chunk_size=1 << 16):
+        """
+        Read src in bounded chunks, the tail which a phrase may still across is kept for next chunk.
+        """
+        carry = ""
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            buf = carry + chunk
+            stop = len(buf) - (self.max_len - 1)
+            if stop <= 0:
+                carry = buf
+                continue
+            converted, end = self._convert_until(buf, stop)
+            dst.write(converted)
+            carry = buf[end:]
+
+        if carry:
+            dst.write(self.convert(carry))
+
+
+_converters = {}
+_lock = threading.Lock()
+
+
+def get_converter(locale='zh-tw', cache_dir=None)-> ZhConverter:
+    """
+    Build once for each locale in this process.
+    """
+    with _lock:
+        if locale not in _converters:
+            _converters[locale] = ZhConverter(locale, cache_dir=cache_dir)
+        return _converters[locale]